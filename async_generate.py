@@ -0,0 +1,173 @@
+import time
+import random
+import asyncio
+
+from response_cache import make_key
+from retry_utils import backoff_delay
+
+
+class TokenBucket():
+    ## 1分あたりrate_per_min個まで (最大capacity個まで貯められる) のtoken bucket
+    def __init__(self, rate_per_min, capacity=None):
+        self.rate = rate_per_min / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_min
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        ## capacityより大きい要求は、capacity分貯まった時点で通す
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class RetryableError(Exception):
+    pass
+
+
+class OpenAIChatClient():
+    ## openai==0.28 のChatCompletion API
+    ## api_baseを指定するとローカルのmock serverなどに向けられる
+    def __init__(self, model='gpt-3.5-turbo', max_tokens=4096, api_base=None):
+        import openai
+        self.openai = openai
+        self.model = model
+        self.max_tokens = max_tokens
+        if api_base:
+            openai.api_base = api_base
+
+    def params(self):
+        return {'model': self.model, 'max_tokens': self.max_tokens}
+
+    async def create(self, messages):
+        errors = self.openai.error
+        try:
+            response = await self.openai.ChatCompletion.acreate(
+                model=self.model,
+                messages=messages,
+                max_tokens=self.max_tokens
+            )
+        except (errors.APIError, errors.Timeout, errors.RateLimitError,
+                errors.ServiceUnavailableError, errors.APIConnectionError) as e:
+            raise RetryableError(str(e)) from e
+        return response.choices[0].message['content'].strip()
+
+
+class StubChatClient():
+    ## APIを呼ばずに決まった文章を返すclient (テスト用)
+    ## fail_rateの確率でRetryableErrorを出す
+    def __init__(self, text='これはテスト用の生成文です。', latency=0.01, fail_rate=0.0, seed=0):
+        self.text = text
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.rng = random.Random(seed)
+
+    def params(self):
+        return {'model': 'stub', 'text': self.text}
+
+    async def create(self, messages):
+        await asyncio.sleep(self.latency * self.rng.random())
+        if self.rng.random() < self.fail_rate:
+            raise RetryableError('stub failure')
+        return self.text + messages[-1]['content'][:20]
+
+
+class CacheMissError(Exception):
+    pass
+
+
+class CacheOnlyClient():
+    ## APIを呼ばずにcacheだけから出力を作り直すためのclient
+    ## paramsは元のclientと同じにしないとcacheのkeyが一致しない
+    def __init__(self, params):
+        self._params = params
+
+    def params(self):
+        return self._params
+
+    async def create(self, messages):
+        raise CacheMissError('response is not in cache')
+
+
+async def request_with_retry(client, messages, max_retries=5, base_delay=1.0, max_delay=60.0):
+    for attempt in range(max_retries):
+        try:
+            return await client.create(messages)
+        except RetryableError as e:
+            if attempt == max_retries - 1:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            print(f"API error: {e} (attempt {attempt+1}/{max_retries}), retry after {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def generate_all(rows, build_messages, client, on_result,
+                       concurrency=8, request_bucket=None, token_bucket=None,
+                       count_tokens=None, completion_tokens=1024,
+                       max_retries=5, base_delay=1.0, max_delay=60.0, cache=None):
+    ## rowsを最大concurrency件まで同時にリクエストし、完了した順ではなく入力順にon_resultを呼ぶ
+    ## 書き出し待ちの結果も含めてconcurrency件までしか保持しない
+    ## rows: (index, row) のiterable (indexは連番), build_messages(row) -> messages
+    ## on_result(index, row, text)
+    ## cacheを指定すると、cacheにある応答はrate limitを消費せずにそのまま使う
+    window = asyncio.Semaphore(concurrency)
+    done = {}
+    next_index = None
+    failures = []
+    tasks = set()
+
+    def flush():
+        nonlocal next_index
+        while next_index in done:
+            row, text = done.pop(next_index)
+            on_result(next_index, row, text)
+            next_index += 1
+            window.release()
+
+    async def run_one(index, row, messages):
+        try:
+            text = None
+            if cache is not None:
+                key = make_key(client.params(), messages)
+                text = cache.get(key)
+            if text is None:
+                if request_bucket is not None:
+                    await request_bucket.acquire(1)
+                if token_bucket is not None:
+                    prompt_tokens = sum(count_tokens(m['content']) for m in messages) if count_tokens else 0
+                    await token_bucket.acquire(prompt_tokens + completion_tokens)
+                text = await request_with_retry(client, messages, max_retries, base_delay, max_delay)
+                if cache is not None:
+                    cache.put(key, client.params(), text)
+        except Exception as e:
+            failures.append((index, e))
+            window.release()
+            raise
+        done[index] = (row, text)
+        flush()
+
+    for index, row in rows:
+        if next_index is None:
+            next_index = index
+        messages = build_messages(row)
+        await window.acquire()
+        if failures:
+            break
+        task = asyncio.create_task(run_one(index, row, messages))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if failures:
+        index, e = failures[0]
+        raise RuntimeError(f'generation failed at index {index}') from e
@@ -0,0 +1,305 @@
+import gc
+import os
+import copy
+import time
+import signal
+import threading
+import collections
+import multiprocessing
+from typing import Any, Iterator, List
+
+from hojichar import Compose, Document
+
+
+def batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def new_filter_stats(name):
+    return {
+        'name': name,
+        'time': 0.0,
+        'docs_in': 0,
+        'docs_out': 0,
+        'rejected': 0,
+        'bytes_in': 0,
+    }
+
+def doc_bytes(doc):
+    ## 統計用の文書のbyte数。読み込み時に元の行の長さを入れておけば (doc.num_bytes)、filterごとにencodeし直さない
+    num_bytes = getattr(doc, 'num_bytes', None)
+    if num_bytes is None:
+        num_bytes = doc.num_bytes = len(doc.text.encode('utf-8'))
+    return num_bytes
+
+def merge_filter_stats(total, stats):
+    ## filterごとの統計を足し合わせる (worker間の集計用)
+    by_name = {s['name']: s for s in total}
+    for s in stats:
+        if s['name'] not in by_name:
+            by_name[s['name']] = new_filter_stats(s['name'])
+            total.append(by_name[s['name']])
+        for k, v in s.items():
+            if k != 'name':
+                by_name[s['name']][k] += v
+    return total
+
+
+class Reorderable():
+    ## 順序を入れ替えても結果が変わらないfilter(rejectするだけのもの)のまとまり
+    def __init__(self, filters: List[Any]) -> None:
+        self.filters = filters
+
+
+class BatchCompose():
+    ## Composeと同じ順でfilterを適用するが、documentのlist単位で処理する
+    ## apply_batchを持つfilterにはまとめて渡し、それ以外は1件ずつapplyする
+    ## rejectされたdocumentは(skip_rejected=Falseのfilterも含め)以降のfilterには渡さない
+    ## profile=Trueならfilterごとの処理時間・件数・reject数・入力byte数 (読み込んだ行のbyte数) を記録する
+    def __init__(self, filters: List[Any], profile: bool = False) -> None:
+        self.filters = []
+        ## Reorderableで囲まれたfilterの範囲 [start, end)
+        self.reorderable_ranges = []
+        for filt in filters:
+            if isinstance(filt, Reorderable):
+                start = len(self.filters)
+                self.filters.extend(filt.filters)
+                self.reorderable_ranges.append((start, len(self.filters)))
+            elif isinstance(filt, Compose):
+                self.filters.extend(filt.filters)
+            else:
+                self.filters.append(filt)
+        self.profile = profile
+        self.ordering = []
+        ## 並べ替える前のfilter (forkしたworkerに並び順を番号で伝えるのに使う)
+        self.base_filters = list(self.filters)
+        self.reset_stats()
+
+    def filter_name(self, idx, filt):
+        return f'{idx}-{filt.__class__.__name__}'
+
+    def reset_stats(self):
+        self.stats = [new_filter_stats(self.filter_name(i, filt)) for i, filt in enumerate(self.filters)]
+
+    def pop_stats(self):
+        stats = self.stats
+        self.reset_stats()
+        return stats
+
+    def filter_order(self):
+        ## 現在の並び順を、並べ替える前のfilterの番号のlistで返す
+        index = {id(filt): i for i, filt in enumerate(self.base_filters)}
+        return [index[id(filt)] for filt in self.filters]
+
+    def set_filter_order(self, order):
+        self.filters = [self.base_filters[i] for i in order]
+        self.reset_stats()
+
+    def apply_filter_batch(self, filt, documents: List[Document], stats=None) -> List[Document]:
+        idx = [i for i, doc in enumerate(documents) if not doc.is_rejected]
+        if not idx:
+            return documents
+        targets = [documents[i] for i in idx]
+        if stats is not None:
+            stats['docs_in'] += len(targets)
+            stats['bytes_in'] += sum(doc_bytes(doc) for doc in targets)
+            start = time.perf_counter()
+        if hasattr(filt, 'apply_batch'):
+            results = filt.apply_batch(targets)
+        else:
+            results = [filt.apply(doc) for doc in targets]
+        if stats is not None:
+            stats['time'] += time.perf_counter() - start
+            kept = sum(1 for doc in results if not doc.is_rejected)
+            stats['docs_out'] += kept
+            stats['rejected'] += len(results) - kept
+        for i, doc in zip(idx, results):
+            ## どのfilterでrejectされたかを残しておく (signal_store.pyで使う)
+            if doc.is_rejected:
+                doc.rejected_by = filt.__class__.__name__
+            documents[i] = doc
+        return documents
+
+    def apply_batch(self, documents: List[Document]) -> List[Document]:
+        documents = list(documents)
+        for i, filt in enumerate(self.filters):
+            stats = self.stats[i] if self.profile else None
+            documents = self.apply_filter_batch(filt, documents, stats)
+        return documents
+
+    def apply(self, document: Document) -> Document:
+        return self.apply_batch([document])[0]
+
+    def reorder(self, sample_docs: List[Document]) -> List[dict]:
+        ## warm-upのsampleで各filterのコストとreject率を測り、
+        ## Reorderableの範囲内を (1件あたりの時間 / reject率) の小さい順に並べ替える
+        ## (安くて多くrejectするfilterほど先に実行する)
+        self.ordering = []
+        for start, end in self.reorderable_ranges:
+            docs = [copy.deepcopy(doc) for doc in sample_docs]
+            for filt in self.filters[:start]:
+                docs = self.apply_filter_batch(filt, docs)
+            docs = [doc for doc in docs if not doc.is_rejected]
+
+            measured = []
+            for filt in self.filters[start:end]:
+                stats = new_filter_stats(filt.__class__.__name__)
+                self.apply_filter_batch(filt, [copy.deepcopy(doc) for doc in docs], stats)
+                cost = stats['time'] / max(1, stats['docs_in'])
+                reject_rate = stats['rejected'] / max(1, stats['docs_in'])
+                rank = cost / reject_rate if reject_rate > 0 else float('inf')
+                measured.append((rank, filt, {
+                    'name': stats['name'],
+                    'cost': cost,
+                    'reject_rate': reject_rate,
+                    'sample_docs': stats['docs_in'],
+                }))
+            measured.sort(key=lambda m: (m[0], m[2]['cost']))
+            self.filters[start:end] = [filt for _, filt, _ in measured]
+            self.ordering.append([info for _, _, info in measured])
+        self.reset_stats()
+        return self.ordering
+
+
+BATCH_BASE_FILTER: BatchCompose
+
+def _init_batch_worker(filter: BatchCompose) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global BATCH_BASE_FILTER
+    BATCH_BASE_FILTER = filter
+
+def _batch_worker(documents: List[Document], order: List[int] = None):
+    ## fork後に親でreorderした場合も、親と同じ順でfilterを適用する
+    if order is not None and order != BATCH_BASE_FILTER.filter_order():
+        BATCH_BASE_FILTER.set_filter_order(order)
+    documents = BATCH_BASE_FILTER.apply_batch(documents)
+    return documents, BATCH_BASE_FILTER.pop_stats()
+
+
+class MemoryGovernor():
+    ## 親とworkerのメモリ使用量の合計 (LinuxではPSS、それ以外はRSS) がlimit_bytesに近づいたら、
+    ## 同時に処理するbatch数 (window) を減らす。下がったら1つずつ戻す
+    ## PSSは共有ページ (fork前に読み込んだKenLMのモデルなど) をプロセス数で割って数えるので、二重に数えない
+    def __init__(self, limit_bytes, max_window, interval=1.0, high=0.9, low=0.75):
+        import psutil
+        self.process = psutil.Process()
+        self.limit_bytes = limit_bytes
+        self.max_window = max_window
+        self.window = max_window
+        self.interval = interval
+        self.high = high
+        self.low = low
+        self.checked = 0.0
+        self.peak_bytes = 0
+
+    def memory_bytes(self):
+        import psutil
+        total = 0
+        for proc in [self.process] + self.process.children(recursive=True):
+            try:
+                info = proc.memory_full_info()
+                total += getattr(info, 'pss', info.rss)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        return total
+
+    def current_window(self):
+        now = time.monotonic()
+        if now - self.checked < self.interval:
+            return self.window
+        self.checked = now
+        used = self.memory_bytes()
+        self.peak_bytes = max(self.peak_bytes, used)
+        if used > self.limit_bytes * self.high and self.window > 1:
+            self.window = max(1, self.window // 2)
+            print(f'memory {used / (1 << 30):.1f}GB is near the limit, window -> {self.window}')
+        elif used < self.limit_bytes * self.low and self.window < self.max_window:
+            self.window += 1
+        return self.window
+
+
+class BatchParallel():
+    ## hojichar.Parallelのbatch版 (入力順を保ったままbatch単位でworkerに渡す)
+    ## workerはforkで作るので、親で読み込んだモデル (PPLFilterのKenLMなど) はcopy-on-writeで共有される
+    ## 処理中・書き出し待ちのbatchはmax_inflight個まで (デフォルトはworker数の2倍) しか先読みしない
+    ## memory_limit (byte) を指定すると、MemoryGovernorでメモリ使用量に応じてmax_inflightより減らす
+    ## gc.freeze()/unfreeze()はプロセス全体に効き、他のthreadがBatchParallelを使っている間にforkすると
+    ## そのworkerも巻き込むので、同時に使えるのはプロセスで1つだけ (2つ目はRuntimeErrorにする)
+    ## 他のthreadがlock (stdoutなど) を持ったままforkすると子プロセスでそのlockが解放されずdeadlockし得るので、
+    ## threadを使う場合 (pre_filter.mainのrun_pipeline) はthreadを起動する前に作り、同じworkerを使い回す
+    _active = threading.Lock()
+
+    def __init__(self, filter: BatchCompose, num_jobs: int = None, batch_size: int = 64,
+                 max_inflight: int = None, memory_limit: int = None) -> None:
+        self.filter = filter
+        self.num_jobs = num_jobs or os.cpu_count()
+        self.batch_size = batch_size
+        self.max_inflight = max_inflight or self.num_jobs * 2
+        self.governor = MemoryGovernor(memory_limit, self.max_inflight) if memory_limit else None
+        self._pool = None
+
+    def __enter__(self) -> 'BatchParallel':
+        if not BatchParallel._active.acquire(blocking=False):
+            raise RuntimeError('another BatchParallel is already running in this process')
+        ## fork前に既存のobjectをGCの対象外にし、子プロセスでのGCによるページのコピーを防ぐ
+        gc.collect()
+        gc.freeze()
+        try:
+            self._pool = multiprocessing.get_context('fork').Pool(
+                processes=self.num_jobs,
+                initializer=_init_batch_worker,
+                initargs=(self.filter,),
+            )
+        except BaseException:
+            gc.unfreeze()
+            BatchParallel._active.release()
+            raise
+        return self
+
+    def window(self) -> int:
+        if self.governor is not None:
+            return self.governor.current_window()
+        return self.max_inflight
+
+    def collect(self, result) -> List[Document]:
+        documents, stats = result.get()
+        ## workerで計測した統計を親のfilterに集計する
+        merge_filter_stats(self.filter.stats, stats)
+        return documents
+
+    def imap_apply(self, docs: Iterator[Document]) -> Iterator[Document]:
+        if self._pool is None:
+            raise RuntimeError(
+                "BatchParallel instance not properly initialized. Use within a 'with' statement."
+            )
+        ## Pool.imapは入力を際限なく先読みするので、apply_asyncでwindow個ずつ投入する
+        ## 同じworkerを複数の入力で使い回す場合に備えて、filterの並び順はbatchと一緒に渡す
+        order = self.filter.filter_order()
+        pending = collections.deque()
+        try:
+            for batch in batched(docs, self.batch_size):
+                pending.append(self._pool.apply_async(_batch_worker, (batch, order)))
+                while len(pending) >= self.window():
+                    yield from self.collect(pending.popleft())
+            while pending:
+                yield from self.collect(pending.popleft())
+        except Exception:
+            ## 投入済みのbatchが終わるのを待ってから抜ける (poolを閉じるのはwithを抜けるとき。次の入力でも使える)
+            for result in pending:
+                result.wait()
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if self._pool:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+            gc.unfreeze()
+            BatchParallel._active.release()
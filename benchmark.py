@@ -0,0 +1,266 @@
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import argparse
+import platform
+import traceback
+import resource
+import itertools
+import subprocess
+import multiprocessing
+
+SEED_FILE = './oscar_ai_added_filtered.jsonl'
+
+
+class StubLanguageModel():
+    ## kenlm.LanguageModelの代わり (オフラインで動かすためのstub)
+    ## tokenのhashから決まるperplexityを返すので、同じ入力なら結果は毎回同じ
+    def perplexity(self, sentence):
+        tokens = sentence.split()
+        if not tokens:
+            return 0.0
+        score = sum(zlib.crc32(t.encode('utf-8')) % 1000 for t in tokens) / len(tokens)
+        return 10 ** (score / 200)
+
+
+class StubSentencePiece():
+    ## sentencepiece.SentencePieceProcessorの代わり。2文字ずつに区切る
+    pattern = re.compile(r'\w{1,2}|\S')
+
+    def encode(self, text, out_type=str):
+        if isinstance(text, list):
+            return [self.encode(t, out_type) for t in text]
+        return self.pattern.findall(text)
+
+
+def load_sentences(seed_file):
+    sentences = []
+    with open(seed_file, encoding='utf-8') as fp:
+        for line in fp:
+            text = json.loads(line)['text']
+            sentences.extend(s for s in re.split(r'(?<=[。！？\n])', text) if s.strip())
+    return sentences
+
+
+def make_corpus(output_file, num_docs, dup_rate=0.1, near_dup_rate=0.05, doc_chars=1500, seed=0, seed_file=SEED_FILE):
+    ## seed_fileの文を組み合わせてOSCAR形式 ({"content": ..., "metadata": ...}) のjsonlを作る
+    ## dup_rateの割合で前の文書の完全な複製、near_dup_rateの割合で一部の文だけ変えた複製を入れる
+    rng = random.Random(seed)
+    sentences = load_sentences(seed_file)
+    docs = []
+    num_bytes = 0
+    with open(output_file, 'w', encoding='utf-8') as fp:
+        for _ in range(num_docs):
+            r = rng.random()
+            if docs and r < dup_rate:
+                text = rng.choice(docs)
+            elif docs and r < dup_rate + near_dup_rate:
+                parts = re.split(r'(?<=[。！？\n])', rng.choice(docs))
+                for _ in range(max(1, len(parts) // 10)):
+                    parts[rng.randrange(len(parts))] = rng.choice(sentences)
+                text = ''.join(parts)
+            else:
+                target = int(rng.expovariate(1 / doc_chars))
+                parts = []
+                length = 0
+                while length < target:
+                    parts.append(rng.choice(sentences))
+                    length += len(parts[-1])
+                text = ''.join(parts)
+            docs.append(text)
+            quality_warnings = ['header'] if rng.random() < 0.1 else None
+            line = json.dumps({'content': text, 'metadata': {'quality_warnings': quality_warnings}}, ensure_ascii=False) + '\n'
+            num_bytes += len(line.encode('utf-8'))
+            fp.write(line)
+    return num_bytes
+
+
+def to_text_jsonl(input_file, output_file, num_docs):
+    ## dedup_all.pyの入力形式 ({"text": ...}) にする
+    with open(input_file, encoding='utf-8') as infile, open(output_file, 'w', encoding='utf-8') as outfile:
+        for line in itertools.islice(infile, num_docs):
+            outfile.write(json.dumps({'text': json.loads(line)['content']}, ensure_ascii=False) + '\n')
+
+
+def iter_documents(input_file):
+    from pre_filter import OscarJSONLoader, read_yielder
+    loader = OscarJSONLoader(key='content', metadata_keys=['quality_warnings'])
+    for doc in read_yielder(input_file):
+        yield loader.apply(doc)
+
+
+def bench_read(input_file, workers, batch_size):
+    from pre_filter import read_yielder
+    return sum(1 for _ in read_yielder(input_file))
+
+
+def bench_space_filter(input_file, workers, batch_size):
+    from pre_filter import SpaceFilter
+    space_filter = SpaceFilter()
+    docs = list(iter_documents(input_file))
+    start = time.perf_counter()
+    for doc in docs:
+        space_filter.apply(doc)
+    return len(docs), time.perf_counter() - start
+
+
+def bench_ppl_filter(input_file, workers, batch_size):
+    from pre_filter import PPLFilter
+    from batch_pipeline import batched
+    ppl_filter = PPLFilter(None, None, ppl_th=90000, model=StubLanguageModel(), sp=StubSentencePiece())
+    docs = list(iter_documents(input_file))
+    start = time.perf_counter()
+    for batch in batched(docs, batch_size):
+        ppl_filter.apply_batch(batch)
+    return len(docs), time.perf_counter() - start
+
+
+def bench_filter_chain(input_file, workers, batch_size):
+    ## clean()と同じfilterを1プロセスで通す (I/Oとworker間の転送を除いた処理時間)
+    from pre_filter import build_cleaner, read_yielder
+    from batch_pipeline import batched
+    cleaner = build_cleaner(ppl_model=StubLanguageModel(), ppl_sp=StubSentencePiece())
+    docs = list(read_yielder(input_file))
+    start = time.perf_counter()
+    for batch in batched(docs, batch_size):
+        cleaner.apply_batch(batch)
+    return len(docs), time.perf_counter() - start
+
+
+def bench_clean(input_file, workers, batch_size, work_dir):
+    import pre_filter
+    output_file = os.path.join(work_dir, f'clean_{workers}.jsonl')
+    pre_filter.clean(input_file, output_file, num_jobs=workers, batch_size=batch_size,
+                     ppl_model=StubLanguageModel(), ppl_sp=StubSentencePiece())
+    with open(pre_filter.report_path(output_file), encoding='utf-8') as fp:
+        return json.load(fp)['total_docs']
+
+
+def bench_dedup(input_file, workers, batch_size, work_dir):
+    ## dedup_all.py --in_fileと同じdedup_in_fileをworker数を変えて計測する
+    import dedup_all
+    output_dir = os.path.join(work_dir, f'dedup_{workers}')
+    os.makedirs(output_dir, exist_ok=True)
+    dedup_all.dedup_in_file([input_file], output_dir, num_worker=workers)
+    with open(input_file, 'rb') as fp:
+        return sum(1 for _ in fp)
+
+
+def run_stage(queue, func, args):
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+        raise
+    elapsed = time.perf_counter() - start
+    ## 計測対象の部分だけの時間を返すstageは (件数, 時間) を返す
+    if isinstance(result, tuple):
+        result, elapsed = result
+    queue.put({
+        'docs': result,
+        'seconds': elapsed,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_children_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    })
+
+
+def measure(name, func, args, input_file, workers):
+    ## peak RSSをstageごとに測るため、各stageは新しいプロセスで実行する
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_stage, args=(queue, func, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    if 'error' in result:
+        raise RuntimeError(f'stage {name} failed:\n' + result['error'])
+    num_bytes = os.path.getsize(input_file)
+    result.update({
+        'stage': name,
+        'workers': workers,
+        'bytes': num_bytes,
+        'docs_per_sec': result['docs'] / result['seconds'] if result['seconds'] > 0 else None,
+        'mb_per_sec': num_bytes / (1 << 20) / result['seconds'] if result['seconds'] > 0 else None,
+    })
+    print(json.dumps(result))
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--docs', type=int, default=5000, help='合成するコーパスの文書数')
+    parser.add_argument('--dedup_docs', type=int, default=200, help='dedupに使う文書数 (LSHの計算が遅いので少なめ)')
+    parser.add_argument('--dup_rate', type=float, default=0.1)
+    parser.add_argument('--near_dup_rate', type=float, default=0.05)
+    parser.add_argument('--doc_chars', type=int, default=1500, help='文書の平均文字数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--seed_file', type=str, default=SEED_FILE)
+    parser.add_argument('--workers', type=str, default='1,2,4', help='clean・dedupを計測するworker数 (カンマ区切り)')
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--stages', type=str, default='read,space_filter,ppl_filter,filter_chain,clean,dedup')
+    parser.add_argument('--work_dir', type=str, default='./benchmark_data')
+    parser.add_argument('--output', type=str, default='./benchmark_result.json')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    os.makedirs(args.work_dir, exist_ok=True)
+    corpus_file = os.path.join(args.work_dir, 'corpus.jsonl')
+    dedup_file = os.path.join(args.work_dir, 'corpus_text.jsonl')
+    corpus_bytes = make_corpus(corpus_file, args.docs, args.dup_rate, args.near_dup_rate,
+                               args.doc_chars, args.seed, args.seed_file)
+    to_text_jsonl(corpus_file, dedup_file, args.dedup_docs)
+    print(f'corpus: {args.docs} docs, {corpus_bytes / (1 << 20):.1f} MB')
+
+    stages = args.stages.split(',')
+    workers_list = [int(w) for w in args.workers.split(',')]
+    single = {
+        'read': bench_read,
+        'space_filter': bench_space_filter,
+        'ppl_filter': bench_ppl_filter,
+        'filter_chain': bench_filter_chain,
+    }
+    results = []
+    for name in stages:
+        if name in single:
+            results.append(measure(name, single[name], (corpus_file, 1, args.batch_size), corpus_file, 1))
+        elif name == 'clean':
+            for workers in workers_list:
+                results.append(measure(name, bench_clean, (corpus_file, workers, args.batch_size, args.work_dir),
+                                       corpus_file, workers))
+        elif name == 'dedup':
+            for workers in workers_list:
+                results.append(measure(name, bench_dedup, (dedup_file, workers, args.batch_size, args.work_dir),
+                                       dedup_file, workers))
+        else:
+            raise ValueError(f'unknown stage: {name}')
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': vars(args),
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as fp:
+        json.dump(report, fp, ensure_ascii=False, indent=2)
+    print(f'results are saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 import os
 import glob
-import gc
-import sys
+import json
+import shutil
+import hashlib
+import unicodedata
 from os import PathLike
 from typing import Any, Union
 from tqdm import tqdm
@@ -9,41 +11,39 @@ import argparse
 import multiprocessing
 
 
-from hojichar import Compose, document_filters, deduplication, Parallel, Document
+from hojichar import Compose, document_filters, deduplication, Document
 from hojichar.core.filter_interface import Filter
 from hojichar.filters.deduplication import LSHDeduplicator
 
+from jsonl_reader import iter_file_lines, iter_shard_lines_with_offset, split_shards
+from lsh_index import LSHBucketIndex, lsh_key
+from manifest import Manifest, file_fingerprint
+from seen_set import SeenSet, make_seen_set
+from output_writer import open_writer
 
-def read_yielder(input_file):    
-    with open(input_file) as fp:        
-        for line in fp.readlines():
-            yield Document(line)
 
-def run_dedup(input_file, output_dir):
-    # print('input_file:',input_file)
-    # print('output_dir', output_dir)    
-    cleaner = get_cleaner(
-                seen=SharedSet(),
-                blacklist=SharedSet()
-            )
-    with open(input_file, 'r', encoding='utf-8') as file:
-        total_lines = sum(1 for _ in file)
-
-    output_file_name = os.path.basename(input_file)
-    output_file = output_dir + '/' + output_file_name
-        
-    BATCH_SIZE = 1000
-    batch = []
-    with open(input_file) as read_fp, open(output_file, 'w') as output_fp:
-        for line in tqdm(read_fp, total=total_lines):
-            text = cleaner(line)
-            if text:
-                batch.append(text)
-                if len(batch) >= BATCH_SIZE:
-                    output_fp.write('\n'.join(batch) + '\n')
-                    batch.clear()
-        if batch:
-            output_fp.write('\n'.join(batch) + '\n')
+def normalize_for_exact(text):
+    ## 完全一致の判定用: NFKCで正規化し、空白の違いは無視する
+    return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+def exact_key(text):
+    ## LSHのkeyと衝突しないようにpersonを変えたblake2bの64bit
+    digest = hashlib.blake2b(normalize_for_exact(text).encode('utf-8'), digest_size=8, person=b'exact').digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+def output_name(input_file):
+    ## .jsonl.zst・.parquetの入力も.jsonlとして書き出す
+    name = os.path.basename(input_file)
+    if name.endswith('.parquet'):
+        return name[:-len('.parquet')] + '.jsonl'
+    return name[:-len('.zst')] if name.endswith('.zst') else name
+
+def output_path(output_dir, input_file, output_format='jsonl'):
+    ## parquetで出力する場合は拡張子を.parquetにする
+    name = output_name(input_file)
+    if output_format == 'parquet':
+        name = os.path.splitext(name)[0] + '.parquet'
+    return output_dir + '/' + name
 
 
 class Debug(Filter):
@@ -68,6 +68,18 @@ class SharedSet():
     def get(self):
         return list(self.shared_set)
 
+    def add_if_absent(self, item):
+        if item in self.shared_set:
+            return False
+        self.shared_set.add(item)
+        return True
+
+    def __contains__(self, item):
+        return item in self.shared_set
+
+    def __len__(self):
+        return len(self.shared_set)
+
 class SharedSetLocked(SharedSet):
     def __init__(self, manager) -> None:
         self.shared_set = manager.list()
@@ -82,6 +94,17 @@ class SharedSetLocked(SharedSet):
         with self.lock:
             return list(self.shared_set)
 
+    def add_if_absent(self, item):
+        with self.lock:
+            if item in self.shared_set:
+                return False
+            self.shared_set.append(item)
+            return True
+
+    def __contains__(self, item):
+        with self.lock:
+            return item in self.shared_set
+
 def recreate_empty_file(file_path):    
     if os.path.exists(file_path):
         print('remove...', file_path)
@@ -92,16 +115,16 @@ def recreate_empty_file(file_path):
 
 class LSHDeduplicatorLockWith(LSHDeduplicator):
     def __init__(self,
-                 share_seen = set(),
-                 shared_black_list = set(),
+                 share_seen = None,
+                 shared_black_list = None,
                  blacklist_path: Union[str, PathLike] = '',
                  recreate_blacklist_file: bool = False,
                  *args: Any, **kwargs: Any) -> None: 
         super().__init__(*args, **kwargs)
         self.blacklist_path = blacklist_path
         self.has_new_seen = False
-        self.seen = share_seen
-        self.blacklist = shared_black_list
+        self.seen = share_seen if share_seen is not None else SeenSet()
+        self.blacklist = shared_black_list if shared_black_list is not None else SeenSet()
 
         if recreate_blacklist_file:
             recreate_empty_file(blacklist_path)
@@ -116,8 +139,9 @@ class LSHDeduplicatorLockWith(LSHDeduplicator):
     def save_black_list(self):
         if not self.has_new_seen:
             return
+        ## 書き出すのは重複と判定したLSH (blacklist) だけ (seenはBloom filterの場合は中身を取り出せない)
         with open(self.blacklist_path, 'w') as fp:            
-            fp.writelines([v+'\n' for v in self.seen.get()])
+            fp.writelines([v+'\n' for v in self.blacklist.get()])
 
     def apply(self, doc):
         lshs = doc.dedup_lsh
@@ -127,11 +151,11 @@ class LSHDeduplicatorLockWith(LSHDeduplicator):
                     `GenerateDedupLSH` must be composed before this filter."
             )
         for lsh in lshs:
-            if lsh in self.seen.get():            
+            ## 確認と追加を1回で行う (共有seen setでもworker間で競合しない)
+            if not self.seen.add_if_absent(lsh):
                 doc.is_rejected = True
                 self.has_new_seen = True
                 self.blacklist.add(lsh)
-            self.seen.add(lsh)
         # self.save_black_list()
         return doc
 
@@ -149,86 +173,328 @@ def get_cleaner(seen, blacklist):
     ])
     return cleaner
 
-def dedup_in_file(filelist, output_dir, num_worker):
+MIN_SHARD_SIZE = 1 << 16
+
+def plan_shards(filelist, num_worker, shard_size=64 << 20):
+    ## 大きいファイルを行境界で [start, end) のshardに分け、ファイルの大きさに偏りがあってもworkerに均等に割り振れるようにする
+    ## seekableな.zst (upload_to_hf.pyなどで--frame_sizeを指定したもの) はframe境界、.parquetはrow group境界で分ける
+    ## 全体がworker数の4倍以上のshardになるようにshard_sizeを小さくする (最小MIN_SHARD_SIZE)
+    total = sum(os.path.getsize(file) for file in filelist)
+    shard_size = max(MIN_SHARD_SIZE, min(shard_size, total // (max(1, num_worker) * 4) + 1))
+    shards = []
+    for file in filelist:
+        num_shards = -(-os.path.getsize(file) // shard_size)
+        ## 空のファイル (pre_filterで全文書がrejectされたpartなど) も空のshardを1つ作り、空の出力を書いて完了を記録する
+        for start, end in split_shards(file, num_shards) or [(0, 0)]:
+            shards.append((file, start, end))
+    return shards
+
+def compute_shard_exact_keys(shard):
+    ## shard内の各行の (行頭のoffset, 完全一致判定用のkey) を返す
+    file, start, end = shard
+    loader = document_filters.JSONLoader(key='text')
+    rows = []
+    for offset, line in iter_shard_lines_with_offset(file, start, end):
+        if not line.strip():
+            continue
+        doc = loader.apply(Document(line.decode('utf-8')))
+        rows.append((offset, None if doc.is_rejected else exact_key(doc.text)))
+    return shard, rows
+
+def compute_shard_lsh(task):
+    ## shard内のskip以外の各行の (行頭のoffset, LSHのkeyのlist) を返す
+    shard, skip = task
+    file, start, end = shard
+    generator = get_lsh_generator()
+    rows = []
+    for offset, line in iter_shard_lines_with_offset(file, start, end):
+        if not line.strip() or offset in skip:
+            continue
+        doc = generator.apply(Document(line.decode('utf-8')))
+        rows.append((offset, None if doc.is_rejected else [lsh_key(lsh) for lsh in doc.dedup_lsh]))
+    return shard, rows
+
+def write_dedup_output(input_file, output_file, rejected, output_format='jsonl'):
+    ## rejectedに含まれない行を {"text": ...} の形式で書き出す
+    loader = document_filters.JSONLoader(key='text')
+    writer = open_writer(output_file + '.part', columns=['text'], format=output_format)
+    for offset, line in iter_shard_lines_with_offset(input_file):
+        if not line.strip() or offset in rejected:
+            continue
+        doc = loader.apply(Document(line.decode('utf-8')))
+        writer.write({'text': doc.text})
+    writer.close()
+    os.replace(output_file + '.part', output_file)
+
+def dedup_in_file(filelist, output_dir, num_worker, seen_set='exact', seen_capacity=100_000_000, bloom_error_rate=1e-4,
+                  manifest=None, shard_size=64 << 20, output_format='jsonl', cross_file=False):
+    ## 全ファイルをbyte範囲のshardに分け、完全一致のhashとLSHの計算(GenerateDedupLSH)をshard単位で並列に行う
+    ## 親プロセスでファイル・offsetの順に確認し、最初に出てきた文書を残す (結果はworker数によらず同じ)
+    ## keyの確認は親プロセスだけで行うので、seen setはプロセス間で共有する必要はない
+    ## cross_file=Trueの場合はファイル間でもseen setを使い回し、ファイル間の重複も除く
     print('run dedup in file...')
     print('output dir', output_dir)
     print('num worker', num_worker)
+    print('seen set', seen_set, 'cross file' if cross_file else '')
+    filelist = sorted(filelist)
+    input_hashes = {}
+    if manifest is not None:
+        input_hashes = {file: file_fingerprint(file) for file in filelist}
+        if cross_file:
+            ## ファイル間のseen setには完了済みのファイルのLSHも必要なので、すべてやり直す
+            print('cross file: manifest is not used to skip files')
+        else:
+            done = [file for file in filelist
+                    if manifest.is_done(os.path.basename(file), 'dedup_in_file', input_hashes[file])]
+            print('skip finished files', len(done))
+            filelist = [file for file in filelist if file not in done]
+    if not filelist:
+        return
+
+    shards = plan_shards(filelist, num_worker, shard_size)
+    remaining = {file: 0 for file in filelist}
+    for file, _, _ in shards:
+        remaining[file] += 1
+    print('num shards', len(shards))
+
+    def new_seen_set():
+        return make_seen_set(seen_set, capacity=seen_capacity, error_rate=bloom_error_rate)
+
+    shared_seen = None
+    shared_exact_seen = None
+    if cross_file:
+        shared_seen = new_seen_set()
+        shared_exact_seen = new_seen_set()
     with multiprocessing.Pool(num_worker) as pool:
-        args = [(file, output_dir) for file in filelist]
-        t = tqdm(total=len(args))
-        for _ in pool.starmap(run_dedup, args):
-            t.update(1)
+        ## 1パス目: 正規化したtextのhashで完全一致の重複を見つける (LSHより十分に軽い)
+        ## 重複した行はskipに入れ、2パス目でLSHを計算しない
+        skips = []
+        exact_counts = {file: 0 for file in filelist}
+        exact_seen = shared_exact_seen
+        current_file = None
+        t = tqdm(total=sum(end - start for _, start, end in shards), unit='B', unit_scale=True)
+        for (file, start, end), rows in pool.imap(compute_shard_exact_keys, shards):
+            if file != current_file:
+                current_file = file
+                exact_seen = shared_exact_seen if shared_exact_seen is not None else new_seen_set()
+            skip = set()
+            for offset, key in rows:
+                if key is None:
+                    skip.add(offset)
+                elif not exact_seen.add_if_absent(key):
+                    skip.add(offset)
+                    exact_counts[file] += 1
+            skips.append(skip)
+            t.update(end - start)
+        t.close()
+        exact_seen = None
+
+        ## 2パス目: 残りの行のLSHを計算し、ファイル・offsetの順に確認する
+        ## imapは順番どおりに結果を返すが、計算は先のshardも並列に進む
+        seen = shared_seen
+        rejected = set()
+        t = tqdm(total=sum(end - start for _, start, end in shards), unit='B', unit_scale=True)
+        for ((file, start, end), rows), skip in zip(pool.imap(compute_shard_lsh, zip(shards, skips)), skips):
+            if seen is None:
+                seen = new_seen_set()
+            rejected |= skip
+            for offset, keys in rows:
+                if keys is None:
+                    rejected.add(offset)
+                    continue
+                is_duplicate = False
+                for key in keys:
+                    if not seen.add_if_absent(key):
+                        is_duplicate = True
+                if is_duplicate:
+                    rejected.add(offset)
+            t.update(end - start)
+            remaining[file] -= 1
+            if remaining[file] > 0:
+                continue
+
+            ## ファイルの全shardを確認し終えたら書き出す
+            output_file = output_path(output_dir, file, output_format)
+            write_dedup_output(file, output_file, rejected, output_format)
+            near_count = len(rejected) - exact_counts[file]
+            print(file, 'removed', len(rejected), 'exact duplicates', exact_counts[file], 'near duplicates', near_count)
+            if manifest is not None:
+                manifest.reset(os.path.basename(file), 'dedup_in_file',
+                               input=file,
+                               input_hash=input_hashes[file],
+                               output=output_file,
+                               removed_lines=len(rejected),
+                               exact_duplicates=exact_counts[file],
+                               near_duplicates=near_count,
+                               done=True)
+            rejected = set()
+            if shared_seen is None:
+                seen = None
         t.close()
 
 
-def async_check_dedup(args):
-    doc, target_file, cleaner  = args
-    target_fp = open(target_file)
-
-    # with open(target_file, 'r', encoding='utf-8') as file:
-    #     total_lines = sum(1 for _ in file)
-
-    for line in target_fp.readlines():
-        target_doc = cleaner(line)
-        
-        lshs = doc.dedup_lsh
-        target_lshs = target_doc.dedup_lsh
-
-        if len(lshs) == 0:
-            print('lshs empty..., may be error')
-            return doc
-        for lsh in lshs:
-            if lsh in target_lshs:
-                doc.is_rejected = True
-                return doc
-    return doc
-    
-
-def local_compose(line):
-    doc = Document(line)
-    doc = document_filters.JSONLoader(key='text').apply(doc)
-    doc = deduplication.GenerateDedupLSH().apply(doc)    
-    return doc
-
-def dedup_between_files(input_file, filelist, output_dir, num_worker=5):
-    output_file_name = os.path.basename(input_file)
-    output_file = output_dir + '/' + output_file_name
-    output_fp = open(output_file, 'w')
-    
-    with open(input_file, 'r', encoding='utf-8') as file:
-        total_lines = sum(1 for _ in file)
-    gc.collect()
-
-    read_fp = open(input_file)
-    for line in tqdm(read_fp.readlines(), total=total_lines):
-        doc = local_compose(line)
-        manager = multiprocessing.Manager()
-        pool = multiprocessing.Pool(num_worker)
-        # progress_dict = manager.dict()
-        # blacklist = SharedSetLocked(manager)
-        # seen = SharedSetLocked(manager)
-        # remove_text = SharedSetLocked(manager)
-        args = [(doc, target_file, local_compose) for target_file in filelist]
-        is_reject = False
-        t2 = tqdm(total=len(args))
-        for result in pool.imap_unordered(async_check_dedup, args):
-            ## 1つでもrejectならreject
-            if not is_reject:                
-                is_reject = result.is_rejected or result.text == ""            
-            t2.update(1)
-        t2.close()
-        if not is_reject:
-            text = {"text": doc.text}
-            output_fp.write(str(text) + "\n")
-        if is_reject:
-            ## 削除対象はそこまで数が多くないと仮定して、削除対象はすべて保存
-            removed_output_file = output_dir + '/removed.jsonl'        
-            with open(removed_output_file, 'a') as remove_fp:
-                text = {"text": doc.text}
-                remove_fp.write(str(text)+'\n')
-        manager.shutdown()
-        pool.close()
-    read_fp.close()
+LSH_GENERATOR = None
+
+def get_lsh_generator():
+    global LSH_GENERATOR
+    if LSH_GENERATOR is None:
+        LSH_GENERATOR = Compose([
+            document_filters.JSONLoader(key='text'),
+            deduplication.GenerateDedupLSH(),
+        ])
+    return LSH_GENERATOR
+
+def compute_lsh_keys(lines):
+    ## lines: (line番号, 行) のlist
+    ## 完全一致の判定用のkeyも1つのバケットとして登録し、同じファイル内の2件目以降はそのkeyだけで重複にする
+    generator = get_lsh_generator()
+    rows = []
+    for line_no, line in lines:
+        doc = generator.apply(Document(line))
+        rows.append((line_no, [lsh_key(lsh) for lsh in doc.dedup_lsh] + [exact_key(doc.text)]))
+    return rows
+
+def split_exact_duplicates(chunks, seen, exact_rows, file_keys):
+    ## 正規化したtextが前の行と完全一致する行はLSHを計算せず、(line番号, [key]) をexact_rowsに入れる
+    ## seenには前のファイルのkeyも入っているので、ファイル間の完全一致の行もLSHを計算しない
+    ## 前の行は必ず前の順位になる (build_lsh_indexでfilelistの順に登録する) ので、LSHを省いても重複の判定は変わらない
+    ## file_keysにはこのファイルで最初に出てきた行のkeyを入れる
+    loader = document_filters.JSONLoader(key='text')
+    for chunk in chunks:
+        unique = []
+        for line_no, line in chunk:
+            key = exact_key(loader.apply(Document(line)).text)
+            if key in seen:
+                exact_rows.append((line_no, [key]))
+            else:
+                seen.add(key)
+                file_keys.add(key)
+                unique.append((line_no, line))
+        if unique:
+            yield unique
+
+def chunk_lines(input_file, chunk_size=1000):
+    chunk = []
+    for line_no, line in enumerate(iter_file_lines(input_file)):
+        if not line.strip():
+            continue
+        chunk.append((line_no, line.decode('utf-8')))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def build_lsh_index(filelist, index_path, num_worker=5):
+    ## filelistの順に登録し、前のファイルまでに出てきた行と完全一致する行はLSHを計算しない
+    ## 登録済みのファイルは再利用し、完全一致のkeyはindexから読む
+    ## ただし他のファイルとの完全一致でLSHを省いたファイルは、そのとき参照したファイルがすべて再利用できて前にある場合だけ再利用する
+    ## (元の行の方が後ろの順位になると、LSHがないので近い重複を見落とす)
+    print('build lsh index...', index_path)
+    index = LSHBucketIndex(index_path)
+    reused = set()
+    targets = set()
+    for path in filelist:
+        if index.is_indexed(path) and index.exact_sources(path) <= reused:
+            reused.add(index.file_id(path))
+        else:
+            targets.add(path)
+    print('skip indexed files', len(filelist) - len(targets))
+    if targets:
+        index.drop_lookup_index()
+        ## 全ファイルの完全一致のkeyをメモリに持つ (dedup_in_fileの--cross_fileと同じ)
+        seen = set()
+        previous_ids = []
+        with multiprocessing.Pool(num_worker) as pool:
+            for path in tqdm(filelist):
+                if path not in targets:
+                    seen.update(index.exact_keys(path))
+                    previous_ids.append(index.file_id(path))
+                    continue
+                file_id = index.begin_file(path)
+                exact_rows = []
+                file_keys = set()
+                for rows in pool.imap(compute_lsh_keys, split_exact_duplicates(chunk_lines(path), seen, exact_rows, file_keys)):
+                    index.add_buckets(file_id, rows)
+                index.add_buckets(file_id, exact_rows)
+                index.add_exact_duplicates(file_id, [line_no for line_no, _ in exact_rows])
+                index.add_exact_keys(file_id, file_keys)
+                if any(keys[0] not in file_keys for _, keys in exact_rows):
+                    index.add_exact_sources(file_id, previous_ids)
+                index.end_file(file_id)
+                previous_ids.append(file_id)
+    index.create_lookup_index()
+    return index
+
+def dedup_between_files(filelist, output_dir, index_path, num_worker=5, manifest=None, output_format='jsonl'):
+    ## 1パス目: 全ファイルのLSHバケットをindexに登録 (作成済みなら再利用)
+    ## 2パス目: indexで重複を解決し、各ファイルを1回だけ読んで書き出す
+    filelist = sorted(filelist)
+    input_hashes = {file: file_fingerprint(file) for file in filelist}
+    ## 他のファイルが変わると重複の判定も変わるので、全ファイルのhashも合わせて記録する
+    corpus_hash = hashlib.blake2b(
+        json.dumps([[file, input_hashes[file]] for file in filelist]).encode(), digest_size=16
+    ).hexdigest()
+
+    def is_done(input_file):
+        if manifest is None:
+            return False
+        name = os.path.basename(input_file)
+        return (manifest.is_done(name, 'dedup_between_files', input_hashes[input_file])
+                and manifest.get(name, 'dedup_between_files').get('corpus_hash') == corpus_hash)
+
+    targets = [file for file in filelist if not is_done(file)]
+    print('skip finished files', len(filelist) - len(targets))
+    index = build_lsh_index(filelist, index_path, num_worker=num_worker)
+    if targets:
+        print('resolve duplicates...')
+        index.resolve_duplicates(filelist)
+
+    ## 削除対象はそこまで数が多くないと仮定して、削除対象はすべて保存
+    ## ファイルごとにremoved/に書き、最後にremoved.jsonlにまとめる (何度実行しても同じ結果になる)
+    removed_dir = output_dir + '/removed'
+    os.makedirs(removed_dir, exist_ok=True)
+    for input_file in tqdm(targets):
+        rejected = index.rejected_lines(input_file)
+        exact_count = len(index.exact_duplicate_lines(input_file) & rejected)
+        output_file = output_path(output_dir, input_file, output_format)
+        removed_file = removed_dir + '/' + output_name(input_file)
+        ## 削除した行はremoved.jsonlにまとめるので、出力の形式によらずjsonlで書く
+        writer = open_writer(output_file + '.part', columns=['text'], format=output_format)
+        with open(removed_file + '.part', 'w') as remove_fp:
+            for line_no, line in enumerate(iter_file_lines(input_file)):
+                if not line.strip():
+                    continue
+                line = line.decode('utf-8').rstrip('\n')
+                if line_no in rejected:
+                    remove_fp.write(line + '\n')
+                else:
+                    writer.write_raw(line)
+        writer.close()
+        os.replace(removed_file + '.part', removed_file)
+        os.replace(output_file + '.part', output_file)
+        if manifest is not None:
+            manifest.reset(os.path.basename(input_file), 'dedup_between_files',
+                           input=input_file,
+                           input_hash=input_hashes[input_file],
+                           corpus_hash=corpus_hash,
+                           output=output_file,
+                           removed=removed_file,
+                           removed_lines=len(rejected),
+                           exact_duplicates=exact_count,
+                           near_duplicates=len(rejected) - exact_count,
+                           done=True)
+        print(input_file, 'removed', len(rejected), 'exact duplicates', exact_count, 'near duplicates', len(rejected) - exact_count)
+    index.close()
+
+    removed_output_file = output_dir + '/removed.jsonl'
+    with open(removed_output_file + '.part', 'wb') as remove_fp:
+        for input_file in filelist:
+            removed_file = removed_dir + '/' + output_name(input_file)
+            if os.path.exists(removed_file):
+                with open(removed_file, 'rb') as fp:
+                    shutil.copyfileobj(fp, remove_fp)
+    os.replace(removed_output_file + '.part', removed_output_file)
     
     
 def get_args():
@@ -238,6 +504,14 @@ def get_args():
     parser.add_argument('--in_file', action='store_true')
     parser.add_argument('--between_file', action='store_true')
     parser.add_argument('--num_worker', type=int, default=4)
+    parser.add_argument('--index_path', type=str, default='')
+    parser.add_argument('--seen_set', type=str, default='exact', choices=['exact', 'bloom'])
+    parser.add_argument('--cross_file', action='store_true', help='in_fileでファイル間の重複も除く')
+    parser.add_argument('--seen_capacity', type=int, default=100_000_000)
+    parser.add_argument('--bloom_error_rate', type=float, default=1e-4)
+    parser.add_argument('--manifest', type=str, default='')
+    parser.add_argument('--shard_size', type=int, default=64, help='in_fileでLSHを並列に計算する単位 (MB)')
+    parser.add_argument('--output_format', type=str, default='jsonl', choices=['jsonl', 'parquet'])
     parser.add_argument('--test', action='store_true')
 
     # parser.add_argument('--blacklist_path', type=str, default='./output/blacklist.txt')
@@ -251,15 +525,26 @@ def main(args):
     num_worker = args.num_worker
  
     print('target', target_dir)
-    filelist = glob.glob(target_dir)
+    ## .jsonl.zstはそのまま展開しながら読み、.parquet (--output_format parquetの出力) はtextの列だけを読む
+    filelist = glob.glob(target_dir) + glob.glob(target_dir + '.zst') + glob.glob(f"{args.target_dir}/*.parquet")
+    ## 再実行時は入力が変わっていない完了済みのファイルを飛ばす
+    manifest = Manifest(args.manifest or output_dir + '/manifest.json')
     if args.in_file:
         print('in file')
-        dedup_in_file(filelist, output_dir, num_worker=num_worker)
+        dedup_in_file(filelist, output_dir, num_worker=num_worker,
+                      seen_set=args.seen_set,
+                      cross_file=args.cross_file,
+                      seen_capacity=args.seen_capacity,
+                      bloom_error_rate=args.bloom_error_rate,
+                      manifest=manifest,
+                      shard_size=args.shard_size << 20,
+                      output_format=args.output_format)
     
     if args.between_file:
         print('between file')
-        for file_path in filelist:
-            dedup_between_files(file_path, filelist, output_dir, num_worker=num_worker)
+        index_path = args.index_path or output_dir + '/lsh_index.sqlite'
+        dedup_between_files(filelist, output_dir, index_path, num_worker=num_worker, manifest=manifest,
+                            output_format=args.output_format)
 
 
 def test():
@@ -277,14 +562,9 @@ def test():
     dedup_in_file(files, output_dir, num_worker=3)
     exit(0)
 
-    input_file = './sample_input/sample.jsonl'
-    filelist = ['./sample_input/sample3.jsonl', './sample_input/sample4.jsonl']
-    output_dir = "dedup2"
-    dedup_between_files(input_file, filelist, output_dir, num_worker=4)
-
-    input_file = './sample_input/sample5.jsonl'
+    filelist = ['./sample_input/sample.jsonl', './sample_input/sample3.jsonl', './sample_input/sample4.jsonl']
     output_dir = "dedup2"
-    dedup_between_files(input_file, filelist, output_dir, num_worker=4)
+    dedup_between_files(filelist, output_dir, output_dir + '/lsh_index.sqlite', num_worker=4)
 
 
 if __name__ == '__main__':    
@@ -1,26 +1,84 @@
 import json
+import argparse
 
-# 元のファイルと出力ファイルのパス
-input_file = "ccc.jsonl"
-output_file = "oscar_ai_added_filtered.jsonl"
+from jsonl_reader import iter_lines
+from keyword_matcher import KeywordMatcher, load_keywords
+from output_writer import detect_format, open_writer
 
-# 除去したいキーワードのリスト
-keywords = ["続きを作成します", "続きを作成いたします", "続きを生成", "申し訳ありませんが", "申し訳ございませんが", "500文字", "the", "作成中"]
+# 除去したいキーワードのリスト (keywords_fileを指定しない場合)
+DEFAULT_KEYWORDS = ["続きを作成します", "続きを作成いたします", "続きを生成", "申し訳ありませんが", "申し訳ございませんが", "500文字", "the", "作成中"]
 #keywords = ["http", "選択してください"]
 
-# チェックするフィールド名
-field_name = "gpt-3.5-turbo_generated_text_wo_prompt"
-#field_name = "text"
-
-# フィルタリング処理
-with open(input_file, 'r', encoding='utf-8') as infile, open(output_file, 'w', encoding='utf-8') as outfile:
-    for line in infile:
-        obj = json.loads(line)  # 1行ずつJSONとして読み込む
-        field_value = obj.get(field_name, "")  # 指定したフィールドの値を取得
-        
-        # テキストが500文字未満か、キーワードが含まれているかをチェック
-        if len(field_value) >= 500 and not any(keyword in field_value for keyword in keywords):
-            # 条件を満たす場合のみ、新しいファイルに書き込む
-            outfile.write(json.dumps(obj, ensure_ascii=False) + '\n')
-
-print(f"フィルタリングされたファイルが出力されました: {output_file}")
\ No newline at end of file
+
+def keep_text(text, min_length, matcher):
+    # テキストが最低文字数以上で、キーワードが含まれていないものを残す
+    return text is not None and len(text) >= min_length and not matcher.contains(text)
+
+
+def filter_parquet(input_file, output_file, field_name, min_length, matcher, batch_size=10000):
+    # row groupをmemory mapで少しずつ読み、判定に使う列から残す行のmaskを作る
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(input_file, memory_map=True)
+    kept = 0
+    total = 0
+    if detect_format(output_file) == 'parquet':
+        writer = pq.ParquetWriter(output_file, parquet_file.schema_arrow, compression='zstd')
+    else:
+        writer = open_writer(output_file)
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        mask = pa.array([keep_text(text, min_length, matcher) for text in batch.column(field_name).to_pylist()])
+        kept_batch = batch.filter(mask)
+        if isinstance(writer, pq.ParquetWriter):
+            writer.write_batch(kept_batch)
+        else:
+            for record in kept_batch.to_pylist():
+                writer.write(record)
+        kept += kept_batch.num_rows
+        total += batch.num_rows
+    writer.close()
+    return kept, total
+
+
+def filter_jsonl(input_file, output_file, field_name, min_length, matcher):
+    if detect_format(input_file) == 'parquet':
+        return filter_parquet(input_file, output_file, field_name, min_length, matcher)
+    kept = 0
+    total = 0
+    with open(output_file, 'wb') as outfile:
+        for line in iter_lines(input_file):
+            if not line.strip():
+                continue
+            total += 1
+            obj = json.loads(line)  # 1行ずつJSONとして読み込む
+            field_value = obj.get(field_name, "")  # 指定したフィールドの値を取得
+
+            # テキストが最低文字数未満か、キーワードが含まれているかをチェック
+            if keep_text(field_value, min_length, matcher):
+                # 条件を満たす場合のみ、元の行をそのまま書き込む
+                outfile.write(line if line.endswith(b'\n') else line + b'\n')
+                kept += 1
+    return kept, total
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', default='ccc.jsonl')
+    parser.add_argument('--output', default='oscar_ai_added_filtered.jsonl')
+    # チェックするフィールド名
+    parser.add_argument('--field', default='gpt-3.5-turbo_generated_text_wo_prompt')
+    parser.add_argument('--min_length', type=int, default=500, help='これより短いものを除く')
+    parser.add_argument('--keywords_file', default=None, help='1行1キーワードのファイル。指定しなければDEFAULT_KEYWORDSを使う')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    keywords = load_keywords(args.keywords_file) if args.keywords_file else DEFAULT_KEYWORDS
+    kept, total = filter_jsonl(args.input, args.output, args.field, args.min_length, KeywordMatcher(keywords))
+    print(f"{total}行中{kept}行を残しました")
+    print(f"フィルタリングされたファイルが出力されました: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+import os
+import json
+import struct
+
+BUFFER_SIZE = 1 << 20
+
+## zstd seekable formatのseek table (skippable frame) のmagic number
+SKIPPABLE_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+
+
+def split_lines(chunks, offset=0):
+    ## bytesのchunk列を行に分割し、(行頭のbyte offset, 行) を返す
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield offset, line + b'\n'
+            offset += len(line) + 1
+    if pending:
+        yield offset, pending
+
+
+def find_line_start(fp, pos, buffer_size=BUFFER_SIZE):
+    ## pos以降で最初の行頭のoffsetを返す (posが行頭ならそのまま)
+    if pos <= 0:
+        return 0
+    fp.seek(pos - 1)
+    while True:
+        chunk = fp.read(buffer_size)
+        if not chunk:
+            return fp.tell()
+        idx = chunk.find(b'\n')
+        if idx >= 0:
+            return pos + idx
+        pos += len(chunk)
+
+
+def split_byte_ranges(input_file, num_shards):
+    ## ファイルを行境界に揃えたnum_shards個の [start, end) に分割する
+    size = os.path.getsize(input_file)
+    num_shards = max(1, num_shards)
+    with open(input_file, 'rb') as fp:
+        bounds = [0]
+        for i in range(1, num_shards):
+            bounds.append(max(bounds[-1], find_line_start(fp, size * i // num_shards)))
+        bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def iter_lines_with_offset(input_file, start=0, end=None, buffer_size=BUFFER_SIZE, on_progress=None):
+    ## [start, end) の範囲で始まる行を (offset, 行bytes) で返す
+    ## 一度に読むのはbuffer_size分だけなので、ファイルサイズによらずメモリは一定
+    with open(input_file, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        end = size if end is None else min(end, size)
+        start = find_line_start(fp, start, buffer_size)
+        fp.seek(start)
+
+        def chunks():
+            pos = start
+            while True:
+                chunk = fp.read(buffer_size)
+                if not chunk:
+                    break
+                if on_progress is not None and pos < end:
+                    on_progress(min(len(chunk), end - pos))
+                pos += len(chunk)
+                yield chunk
+
+        for offset, line in split_lines(chunks(), start):
+            if offset >= end:
+                break
+            yield offset, line
+
+
+def iter_lines(input_file, start=0, end=None, buffer_size=BUFFER_SIZE, on_progress=None):
+    for _, line in iter_lines_with_offset(input_file, start, end, buffer_size, on_progress):
+        yield line
+
+
+def iter_zst_lines_with_offset(input_file, start=0, on_progress=None, chunk_size=BUFFER_SIZE):
+    ## .zstを展開しながら (展開後のoffset, 行bytes) を返す
+    ## 展開後のoffsetでのseekはできないので、startより前の行は展開して読み飛ばす
+    ## on_progressには読み進めた圧縮後のbyte数を渡す
+    import zstandard as zstd
+    with open(input_file, 'rb') as compressed_fp:
+        decompressor = zstd.ZstdDecompressor()
+        with decompressor.stream_reader(compressed_fp, read_across_frames=True) as reader:
+            def chunks():
+                last_pos = 0
+                while True:
+                    chunk = reader.read(chunk_size)
+                    if not chunk:
+                        break
+                    if on_progress is not None:
+                        pos = compressed_fp.tell()
+                        on_progress(pos - last_pos)
+                        last_pos = pos
+                    yield chunk
+
+            for offset, line in split_lines(chunks()):
+                if offset >= start:
+                    yield offset, line
+
+
+def iter_zst_lines(input_file, on_progress=None, chunk_size=BUFFER_SIZE):
+    for _, line in iter_zst_lines_with_offset(input_file, on_progress=on_progress, chunk_size=chunk_size):
+        yield line
+
+
+def read_zst_seek_table(input_file):
+    ## 末尾のseek tableから各frameの (圧縮後のoffset, 圧縮後のsize, 展開後のoffset, 展開後のsize) を返す
+    ## seek tableがない (seekableでない) .zstならNone
+    with open(input_file, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        if size < 17:
+            return None
+        fp.seek(size - 9)
+        num_frames, descriptor, magic = struct.unpack('<IBI', fp.read(9))
+        if magic != SEEKABLE_MAGIC:
+            return None
+        entry_size = 12 if descriptor & 0x80 else 8
+        table_size = num_frames * entry_size + 9
+        if size < table_size + 8:
+            return None
+        fp.seek(size - table_size - 8)
+        skippable_magic, frame_size = struct.unpack('<II', fp.read(8))
+        if skippable_magic != SKIPPABLE_MAGIC or frame_size != table_size:
+            return None
+        entries = fp.read(num_frames * entry_size)
+
+    frames = []
+    compressed_offset = 0
+    decompressed_offset = 0
+    for i in range(num_frames):
+        compressed_size, decompressed_size = struct.unpack_from('<II', entries, i * entry_size)
+        frames.append((compressed_offset, compressed_size, decompressed_offset, decompressed_size))
+        compressed_offset += compressed_size
+        decompressed_offset += decompressed_size
+    return frames
+
+
+def split_zst_frames(input_file, num_shards):
+    ## seekableな.zstをframe境界でnum_shards個の [start, end) (圧縮後のoffset) に分割する
+    ## seekableでなければ分割できないので全体を1つで返す
+    frames = read_zst_seek_table(input_file)
+    if not frames:
+        return [(0, os.path.getsize(input_file))]
+    num_shards = max(1, num_shards)
+    total = sum(frame[1] for frame in frames)
+    bounds = [0]
+    for compressed_offset, compressed_size, _, _ in frames:
+        if len(bounds) < num_shards and compressed_offset >= total * len(bounds) / num_shards and compressed_offset > bounds[-1]:
+            bounds.append(compressed_offset)
+    bounds.append(total)
+    return list(zip(bounds, bounds[1:]))
+
+
+def iter_zst_frame_lines_with_offset(input_file, start=0, end=None, on_progress=None):
+    ## seekableな.zstのうち [start, end) から始まるframeだけを展開し、(展開後のoffset, 行bytes) を返す
+    ## 各frameは行の途中で切れていないので、frameごとに独立に読める
+    import zstandard as zstd
+    frames = read_zst_seek_table(input_file)
+    if frames is None:
+        raise ValueError(f'not a seekable zst file: {input_file}')
+    decompressor = zstd.ZstdDecompressor()
+    with open(input_file, 'rb') as fp:
+        for compressed_offset, compressed_size, decompressed_offset, decompressed_size in frames:
+            if compressed_offset < start or (end is not None and compressed_offset >= end):
+                continue
+            fp.seek(compressed_offset)
+            data = decompressor.decompress(fp.read(compressed_size), max_output_size=decompressed_size)
+            if on_progress is not None:
+                on_progress(compressed_size)
+            yield from split_lines([data], decompressed_offset)
+
+
+def parquet_row_groups(input_file):
+    ## 各row groupの (先頭の行番号, 行数) を返す
+    import pyarrow.parquet as pq
+    metadata = pq.ParquetFile(input_file).metadata
+    row_groups = []
+    first_row = 0
+    for i in range(metadata.num_row_groups):
+        num_rows = metadata.row_group(i).num_rows
+        row_groups.append((first_row, num_rows))
+        first_row += num_rows
+    return row_groups
+
+
+def split_parquet_row_groups(input_file, num_shards):
+    ## .parquetをrow group境界でnum_shards個の [start, end) (行番号) に分割する
+    row_groups = parquet_row_groups(input_file)
+    num_shards = max(1, num_shards)
+    total = sum(num_rows for _, num_rows in row_groups)
+    bounds = [0]
+    for first_row, _ in row_groups:
+        if len(bounds) < num_shards and first_row >= total * len(bounds) / num_shards and first_row > bounds[-1]:
+            bounds.append(first_row)
+    bounds.append(total)
+    return list(zip(bounds, bounds[1:]))
+
+
+def iter_parquet_lines_with_offset(input_file, start=0, end=None):
+    ## [start, end) から始まるrow groupのtextの列だけを読み、(行番号, {"text": ...}の行bytes) を返す
+    from output_writer import read_records
+    row_groups = [(i, first_row) for i, (first_row, _) in enumerate(parquet_row_groups(input_file))
+                  if first_row >= start and (end is None or first_row < end)]
+    if not row_groups:
+        return
+    row = row_groups[0][1]
+    for record in read_records(input_file, columns=['text'], row_groups=[i for i, _ in row_groups]):
+        yield row, (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        row += 1
+
+
+def split_shards(input_file, num_shards):
+    ## .zstならframe境界 (seekableな場合)、.parquetならrow group境界、それ以外は行境界でnum_shards個の [start, end) に分割する
+    if input_file.endswith('.zst'):
+        return split_zst_frames(input_file, num_shards)
+    if input_file.endswith('.parquet'):
+        return split_parquet_row_groups(input_file, num_shards)
+    return split_byte_ranges(input_file, num_shards)
+
+
+def iter_shard_lines_with_offset(input_file, start=0, end=None):
+    ## split_shardsで分けた [start, end) の行を (offset, 行bytes) で返す (.zstなら展開後のoffset、.parquetなら行番号)
+    ## seekableでない.zstは分割されないので、先頭から全体を展開する
+    if input_file.endswith('.parquet'):
+        yield from iter_parquet_lines_with_offset(input_file, start, end)
+        return
+    if input_file.endswith('.zst'):
+        if read_zst_seek_table(input_file) is None:
+            yield from iter_zst_lines_with_offset(input_file)
+        else:
+            yield from iter_zst_frame_lines_with_offset(input_file, start, end)
+        return
+    yield from iter_lines_with_offset(input_file, start, end)
+
+
+def iter_file_lines(input_file):
+    ## .jsonl・.jsonl.zst・.parquet (textの列) のどれも1行ずつ返す
+    for _, line in iter_shard_lines_with_offset(input_file):
+        yield line
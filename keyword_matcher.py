@@ -0,0 +1,59 @@
+import re
+
+
+def load_keywords(path):
+    ## 1行1キーワードのファイルを読む (空行は無視、重複は除く)
+    with open(path, encoding='utf-8') as fp:
+        words = [w.strip() for w in fp.read().split('\n')]
+    return list(dict.fromkeys(w for w in words if w))
+
+
+def build_trie(words):
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = {}
+    return trie
+
+
+def trie_to_pattern(node):
+    ## 共通のprefixをまとめた正規表現にする
+    ## 含むかどうかだけを見るので、他のキーワードで終わる枝 (より長いキーワード) は省く
+    if '' in node:
+        return ''
+    alternatives = []
+    chars = []
+    for ch in sorted(node):
+        sub = trie_to_pattern(node[ch])
+        if sub:
+            alternatives.append(re.escape(ch) + sub)
+        else:
+            chars.append(re.escape(ch))
+    if chars:
+        alternatives.append(chars[0] if len(chars) == 1 else '[' + ''.join(chars) + ']')
+    if len(alternatives) == 1:
+        return alternatives[0]
+    return '(?:' + '|'.join(alternatives) + ')'
+
+
+class KeywordMatcher():
+    ## 複数のキーワードを1つの正規表現にまとめ、1回の走査でどれかを含むかを判定する
+    ## キーワードをそのまま | でつなぐと各位置で全キーワードを試すが、
+    ## trieにしておけば各位置で試すのは1文字目が一致する枝だけになる
+    def __init__(self, keywords):
+        self.keywords = list(dict.fromkeys(w for w in keywords if w))
+        self.pattern = re.compile(trie_to_pattern(build_trie(self.keywords))) if self.keywords else None
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(load_keywords(path))
+
+    def search(self, text):
+        if self.pattern is None:
+            return None
+        return self.pattern.search(text)
+
+    def contains(self, text):
+        return self.search(text) is not None
@@ -0,0 +1,184 @@
+import os
+import sqlite3
+import hashlib
+
+
+def lsh_key(lsh):
+    ## LSH文字列(例: "0+a1b2...")を符号付き64bit整数に変換する
+    digest = hashlib.blake2b(lsh.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+class LSHBucketIndex():
+    ## LSHバケット -> (file, line) のディスク上のindex
+    ## ファイルのsize, mtimeが変わっていなければ前回の結果を再利用する
+    LINE_BITS = 32
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.conn = sqlite3.connect(index_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE,
+                size INTEGER,
+                mtime REAL,
+                complete INTEGER DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS buckets (
+                lsh INTEGER,
+                file_id INTEGER,
+                line INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS exact_duplicates (
+                file_id INTEGER,
+                line INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS exact_keys (
+                key INTEGER,
+                file_id INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS exact_sources (
+                file_id INTEGER,
+                source_file_id INTEGER
+            );
+        ''')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def _file_row(self, path):
+        return self.conn.execute(
+            'SELECT id, size, mtime, complete FROM files WHERE path = ?',
+            (os.path.abspath(path),)
+        ).fetchone()
+
+    def is_indexed(self, path):
+        row = self._file_row(path)
+        if row is None:
+            return False
+        _, size, mtime, complete = row
+        stat = os.stat(path)
+        return bool(complete) and size == stat.st_size and mtime == stat.st_mtime
+
+    def file_id(self, path):
+        row = self._file_row(path)
+        return None if row is None else row[0]
+
+    def begin_file(self, path):
+        ## 古いエントリを削除してからファイルを登録し直す
+        abspath = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self._file_row(path)
+        if row is not None:
+            self.conn.execute('DELETE FROM buckets WHERE file_id = ?', (row[0],))
+            self.conn.execute('DELETE FROM exact_duplicates WHERE file_id = ?', (row[0],))
+            self.conn.execute('DELETE FROM exact_keys WHERE file_id = ?', (row[0],))
+            self.conn.execute('DELETE FROM exact_sources WHERE file_id = ?', (row[0],))
+            self.conn.execute(
+                'UPDATE files SET size = ?, mtime = ?, complete = 0 WHERE id = ?',
+                (stat.st_size, stat.st_mtime, row[0])
+            )
+            file_id = row[0]
+        else:
+            cur = self.conn.execute(
+                'INSERT INTO files (path, size, mtime) VALUES (?, ?, ?)',
+                (abspath, stat.st_size, stat.st_mtime)
+            )
+            file_id = cur.lastrowid
+        self.conn.commit()
+        return file_id
+
+    def add_buckets(self, file_id, rows):
+        ## rows: (line, [lsh_key, ...]) のiterable
+        self.conn.executemany(
+            'INSERT INTO buckets (lsh, file_id, line) VALUES (?, ?, ?)',
+            ((key, file_id, line) for line, keys in rows for key in keys)
+        )
+
+    def add_exact_duplicates(self, file_id, lines):
+        ## LSHを計算せずに完全一致で重複とした行 (集計用)
+        self.conn.executemany(
+            'INSERT INTO exact_duplicates (file_id, line) VALUES (?, ?)',
+            ((file_id, line) for line in lines)
+        )
+
+    def exact_duplicate_lines(self, path):
+        file_id = self.file_id(path)
+        rows = self.conn.execute('SELECT line FROM exact_duplicates WHERE file_id = ?', (file_id,))
+        return set(line for line, in rows)
+
+    def add_exact_keys(self, file_id, keys):
+        ## ファイル内で最初に出てきた行の完全一致のkey (後のファイルでLSHを省く判定に使う)
+        self.conn.executemany(
+            'INSERT INTO exact_keys (key, file_id) VALUES (?, ?)',
+            ((key, file_id) for key in keys)
+        )
+
+    def exact_keys(self, path):
+        file_id = self.file_id(path)
+        rows = self.conn.execute('SELECT key FROM exact_keys WHERE file_id = ?', (file_id,))
+        return [key for key, in rows]
+
+    def add_exact_sources(self, file_id, source_file_ids):
+        ## 他のファイルとの完全一致でLSHを省いたときに、完全一致のkeyを参照したファイル
+        self.conn.executemany(
+            'INSERT INTO exact_sources (file_id, source_file_id) VALUES (?, ?)',
+            ((file_id, source_file_id) for source_file_id in source_file_ids)
+        )
+
+    def exact_sources(self, path):
+        file_id = self.file_id(path)
+        rows = self.conn.execute('SELECT source_file_id FROM exact_sources WHERE file_id = ?', (file_id,))
+        return set(source_file_id for source_file_id, in rows)
+
+    def end_file(self, file_id):
+        self.conn.execute('UPDATE files SET complete = 1 WHERE id = ?', (file_id,))
+        self.conn.commit()
+
+    def create_lookup_index(self):
+        ## 一括挿入が終わってからindexを張る
+        self.conn.execute('CREATE INDEX IF NOT EXISTS buckets_lsh ON buckets (lsh)')
+        self.conn.commit()
+
+    def drop_lookup_index(self):
+        self.conn.execute('DROP INDEX IF EXISTS buckets_lsh')
+        self.conn.commit()
+
+    def resolve_duplicates(self, filelist):
+        ## filelistの順序 -> 行番号の順で最初に出現したものを残し、
+        ## いずれかのバケットがそれより前に出現している (file, line) を重複とする
+        self.conn.execute('DROP TABLE IF EXISTS temp.ranks')
+        self.conn.execute('DROP TABLE IF EXISTS temp.first_seen')
+        self.conn.execute('DROP TABLE IF EXISTS temp.rejected')
+        self.conn.execute('CREATE TEMP TABLE ranks (file_id INTEGER PRIMARY KEY, rank INTEGER)')
+        self.conn.executemany(
+            'INSERT INTO ranks (file_id, rank) VALUES (?, ?)',
+            [(self.file_id(path), rank) for rank, path in enumerate(filelist)]
+        )
+        self.conn.execute(f'''
+            CREATE TEMP TABLE first_seen AS
+            SELECT b.lsh AS lsh, MIN((r.rank << {self.LINE_BITS}) + b.line) AS pos
+            FROM buckets b JOIN ranks r ON b.file_id = r.file_id
+            GROUP BY b.lsh
+            HAVING COUNT(*) > 1
+        ''')
+        self.conn.execute('CREATE INDEX temp.first_seen_lsh ON first_seen (lsh)')
+        self.conn.execute(f'''
+            CREATE TEMP TABLE rejected AS
+            SELECT DISTINCT b.file_id AS file_id, b.line AS line
+            FROM buckets b
+            JOIN ranks r ON b.file_id = r.file_id
+            JOIN first_seen f ON b.lsh = f.lsh
+            WHERE (r.rank << {self.LINE_BITS}) + b.line > f.pos
+        ''')
+        self.conn.execute('CREATE INDEX temp.rejected_file ON rejected (file_id)')
+        self.conn.commit()
+
+    def rejected_lines(self, path):
+        file_id = self.file_id(path)
+        rows = self.conn.execute('SELECT line FROM rejected WHERE file_id = ?', (file_id,))
+        return set(line for line, in rows)
@@ -0,0 +1,66 @@
+import os
+import json
+import hashlib
+import threading
+
+
+def atomic_write(path, data, mode='w'):
+    ## 一時ファイルに書いてからrenameするので、途中で落ちても壊れたファイルが残らない
+    tmp_path = path + '.tmp'
+    with open(tmp_path, mode) as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+
+def file_fingerprint(path, sample_size=1 << 20):
+    ## 全体をhashすると時間がかかるので、サイズと先頭・末尾のみをhashする
+    size = os.path.getsize(path)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode())
+    with open(path, 'rb') as fp:
+        h.update(fp.read(sample_size))
+        if size > sample_size:
+            fp.seek(max(sample_size, size - sample_size))
+            h.update(fp.read(sample_size))
+    return h.hexdigest()
+
+
+class Manifest():
+    ## part(ファイル)とstageごとに、入力のhash・処理済みのoffset・出力ファイルなどを記録する
+    ## {part: {stage: {"input_hash": ..., "offset": ..., "output": ..., "done": ...}}}
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as fp:
+                self.entries = json.load(fp)
+
+    def get(self, part, stage):
+        with self.lock:
+            return dict(self.entries.get(str(part), {}).get(stage, {}))
+
+    def update(self, part, stage, **fields):
+        with self.lock:
+            entry = self.entries.setdefault(str(part), {}).setdefault(stage, {})
+            entry.update(fields)
+            self.save()
+
+    def reset(self, part, stage, **fields):
+        with self.lock:
+            self.entries.setdefault(str(part), {})[stage] = dict(fields)
+            self.save()
+
+    def is_done(self, part, stage, input_hash=None):
+        entry = self.get(part, stage)
+        if not entry.get('done'):
+            return False
+        if input_hash is not None and entry.get('input_hash') != input_hash:
+            return False
+        output = entry.get('output')
+        return output is None or os.path.exists(output)
+
+    def save(self):
+        atomic_write(self.path, json.dumps(self.entries, ensure_ascii=False, indent=2))
@@ -1,24 +1,134 @@
+import os
+import re
+import glob
 import json
+import heapq
+import hashlib
+import argparse
 
-# 結合するファイルのリスト
-file_paths = ["oscar_ai_added_1_3772.jsonl", "oscar_ai_added_3773_5015.jsonl", "oscar_ai_added_5016_20564.jsonl"]
-# 出力するファイル名
-output_file = "oscar_ai_added.jsonl"
+from jsonl_reader import iter_lines
+from output_writer import read_records
+from seen_set import make_seen_set
 
-# 結合したデータを格納するリスト
-merged_data = []
 
-# 各ファイルを1つずつ読み込む
-for file_path in file_paths:
-    with open(file_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            # JSONとして読み込んでリストに追加
-            merged_data.append(json.loads(line))
+def natural_key(path):
+    ## result/2.jsonl が result/10.jsonl より前に来るように、数字は数値として比較する
+    return [int(s) if s.isdigit() else s for s in re.split(r'(\d+)', path)]
 
-# 新しいファイルに書き込む
-with open(output_file, 'w', encoding='utf-8') as f:
-    for item in merged_data:
-        # JSON Lines形式で1行ずつ書き出す
-        f.write(json.dumps(item, ensure_ascii=False) + '\n')
 
-print(f"ファイルが正常に結合されました: {output_file}")
\ No newline at end of file
+def expand_inputs(patterns):
+    ## globを展開する。パターンの順番は保ち、各パターン内はnatural sortする
+    paths = []
+    for pattern in patterns:
+        matched = sorted(glob.glob(pattern), key=natural_key)
+        if not matched:
+            raise FileNotFoundError(pattern)
+        paths.extend(p for p in matched if p not in paths)
+    return paths
+
+
+def iter_input_lines(path):
+    ## .parquetは1レコードずつJSONの行にする
+    if path.endswith('.parquet'):
+        for record in read_records(path):
+            yield (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        return
+    yield from iter_lines(path)
+
+
+def iter_all_lines(paths):
+    for path in paths:
+        for line in iter_input_lines(path):
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            yield line
+
+
+def iter_merged_lines(paths, key):
+    ## 各ファイルがkeyの昇順に並んでいる前提で、heapでk-way mergeする
+    ## keyが同じ行はファイルの順番を優先する
+    def keyed(idx, path):
+        for line in iter_input_lines(path):
+            if not line.strip():
+                continue
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            yield json.loads(line)[key], idx, line
+
+    for _, _, line in heapq.merge(*[keyed(idx, path) for idx, path in enumerate(paths)]):
+        yield line
+
+
+def dedup_key(line, field=None):
+    if field is not None:
+        value = json.loads(line)[field]
+        line = json.dumps(value, ensure_ascii=False).encode('utf-8')
+    return hashlib.blake2b(line.rstrip(b'\n'), digest_size=16).digest()
+
+
+def concat_files(paths, output_file, buffer_size=1 << 20):
+    ## 変換が不要な場合は中身をそのままコピーする
+    with open(output_file, 'wb') as outfile:
+        for path in paths:
+            last = b'\n'
+            with open(path, 'rb') as infile:
+                while True:
+                    chunk = infile.read(buffer_size)
+                    if not chunk:
+                        break
+                    outfile.write(chunk)
+                    last = chunk[-1:]
+            ## 改行で終わっていないファイルは次のファイルと行がつながらないように改行を足す
+            if last != b'\n':
+                outfile.write(b'\n')
+
+
+def merge(paths, output_file, key=None, dedup=None, dedup_field=None,
+          seen_capacity=100_000_000, bloom_error_rate=1e-4):
+    tmp_file = output_file + '.part'
+    written = 0
+    removed = 0
+    ## .parquetはそのままコピーできないので1行ずつ変換する
+    if key is None and dedup is None and not any(path.endswith('.parquet') for path in paths):
+        concat_files(paths, tmp_file)
+    else:
+        lines = iter_merged_lines(paths, key) if key is not None else iter_all_lines(paths)
+        seen = make_seen_set(dedup, seen_capacity, bloom_error_rate) if dedup is not None else None
+        with open(tmp_file, 'wb') as outfile:
+            for line in lines:
+                if seen is not None and not seen.add_if_absent(dedup_key(line, dedup_field)):
+                    removed += 1
+                    continue
+                outfile.write(line)
+                written += 1
+    os.replace(tmp_file, output_file)
+    return written, removed
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', nargs='+', help='結合するファイル (globも可)。指定した順番に結合する')
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--key', default=None, help='各ファイルがこのfieldの昇順に並んでいる場合に、順番を保ってmergeする')
+    parser.add_argument('--dedup', choices=['exact', 'bloom'], default=None, help='完全一致する行を除く')
+    parser.add_argument('--dedup_field', default=None, help='行全体ではなくこのfieldの値で重複を判定する')
+    parser.add_argument('--seen_capacity', type=int, default=100_000_000, help='bloom filterのサイズ (想定する行数)')
+    parser.add_argument('--bloom_error_rate', type=float, default=1e-4)
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    paths = expand_inputs(args.inputs)
+    if os.path.abspath(args.output) in [os.path.abspath(p) for p in paths]:
+        raise ValueError(f'output file is also an input: {args.output}')
+    print('input files:', paths)
+    written, removed = merge(paths, args.output, key=args.key, dedup=args.dedup, dedup_field=args.dedup_field,
+                             seen_capacity=args.seen_capacity, bloom_error_rate=args.bloom_error_rate)
+    if args.dedup is not None:
+        print(f'{written} lines written, {removed} duplicates removed')
+    print(f"ファイルが正常に結合されました: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,72 +1,170 @@
 # !pip install openai==0.28
 # !pip install tiktoken
-import openai
-import tiktoken
+import os
 import json
-import time
+import asyncio
+import argparse
+import functools
+import itertools
+import tiktoken
+try:
+    import regex
+except ImportError:
+    regex = None
+
+from async_generate import TokenBucket, OpenAIChatClient, StubChatClient, CacheOnlyClient, generate_all
+from response_cache import ResponseCache
 
 # OpenAI APIキーの設定
 # ここにAPIキーを設定
 
+# gpt-3.5-turboのエンコーディングを取得 (読み込みは1回だけ)
+@functools.lru_cache(maxsize=None)
+def get_encoding(model="gpt-3.5-turbo"):
+    return tiktoken.encoding_for_model(model)
+
+# 先頭のwindow文字のうち、後ろに文字が続いてもトークン分割が変わらない部分を返す
+# tiktokenは正規表現で区切った単位ごとにトークン化するので、途中で切れている可能性がある末尾の2区切りを除く
+# 区切りの正規表現 (Encodingの非公開の属性_pat_str) かregexが使えない場合は、全文を返す (全文をトークン化するので遅いが結果は同じ)
+def stable_prefix(enc, text, window):
+    if window >= len(text):
+        return text
+    pat_str = getattr(enc, '_pat_str', None)
+    if regex is None or pat_str is None:
+        return text
+    pieces = [m.start() for m in regex.finditer(pat_str, text[:window])]
+    if len(pieces) < 2:
+        return ''
+    return text[:pieces[-2]]
+
+# 複数のテキストからそれぞれ最初のNトークンを抽出する関数
+# 全文ではなく、Nトークン以上になることが保証される範囲の先頭の文字だけをトークン化する
+def get_N_tokens_batch(texts, N, model="gpt-3.5-turbo", num_threads=8):
+    enc = get_encoding(model)
+    results = [None] * len(texts)
+    pending = list(range(len(texts)))
+    window = 4 * N + 64
+    while pending:
+        prefixes = [stable_prefix(enc, texts[i], window) for i in pending]
+        tokens_list = enc.encode_ordinary_batch(prefixes, num_threads=num_threads)
+        retry = []
+        for i, prefix, tokens in zip(pending, prefixes, tokens_list):
+            if len(tokens) >= N or len(prefix) == len(texts[i]):
+                results[i] = tokens[:N]
+            else:
+                retry.append(i)
+        pending = retry
+        window *= 2
+    # トークンをデコードして文字列にする
+    return enc.decode_batch(results, num_threads=num_threads)
+
 # 最初のNトークンを抽出する関数
 def get_N_tokens(text, N):
-    # gpt-3.5-turboのエンコーディングを取得
-    enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    # テキストをトークン化
-    tokens = enc.encode(text)
-    # 最初のNトークンを取得
-    first_N_tokens = tokens[:N]
-    # トークンをデコードして文字列にする
-    first_N_text = enc.decode(first_N_tokens)
-    return first_N_text
+    return get_N_tokens_batch([text], N)[0]
+
+def count_tokens(text):
+    return len(get_encoding().encode_ordinary(text))
 
-# GPT-3.5を使ってテキストを生成する関数
-def generate_text(prompt, retries=5, delay=5):
+# GPT-3.5に渡すmessagesを作成する関数
+def build_messages(prompt):
     user_prompt1 = (
         f"以下の()内の文章の続きを作成してください。"
         f"出力は与えられた文章部分は出力せず、作成した部分のみを出力してください。文字数は500文字で出力してください。\n"
         f"({prompt})"
     )
     user_prompt2 = "続きを500文字で作成してください。"
+    return [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": user_prompt1},
+        {"role": "user", "content": user_prompt2},
+        {"role": "user", "content": user_prompt2}
+    ]
 
-    for i in range(retries):
-        try:
-            response1 = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": user_prompt1},
-                    {"role": "user", "content": user_prompt2},
-                    {"role": "user", "content": user_prompt2}
-                ],
-                max_tokens=4096
-            )
-            return response1.choices[0].message['content'].strip()
-        except openai.error.APIError as e:
-            print(f"API error: {e} (attempt {i+1}/{retries})")
-            if i < retries - 1:
-                time.sleep(delay)
-            else:
-                raise e
-
-# ファイルの読み込み
-input_file_path = './oscar.jsonl'
-output_file_path = './oscar_ai_added.jsonl'
-"""
-# 途中から実行するための設定
-start_line = 2355  # ここに開始したい行番号を指定
-"""
-with open(input_file_path, 'r', encoding='utf-8') as infile, open(output_file_path, 'w', encoding='utf-8') as outfile:
-    for line in infile:
-        data = json.loads(line.strip())
-        prompt = get_N_tokens(data['text'], 50)
-        ai_text = generate_text(prompt)
-        ai_text_512 = get_N_tokens(ai_text, 512)
-
-        # 新しいフィールドを追加
-        data['gpt-3.5-turbo_generated_text_wo_prompt'] = ai_text_512
-
-        # JSON形式で出力
-        json.dump(data, outfile, ensure_ascii=False)
-        outfile.write('\n')
-print(f"AI生成テキストが {output_file_path} に保存されました。")
\ No newline at end of file
+def count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb') as fp:
+        return sum(1 for _ in fp)
+
+def read_rows(input_file_path, start_line, batch_size=256):
+    ## プロンプト (最初の50トークン) はbatch_size行ずつまとめて作る
+    with open(input_file_path, 'r', encoding='utf-8') as infile:
+        lines = enumerate(infile)
+        lines = itertools.islice(lines, start_line, None)
+        while True:
+            batch = list(itertools.islice(lines, batch_size))
+            if not batch:
+                break
+            rows = [(i, json.loads(line.strip())) for i, line in batch]
+            prompts = get_N_tokens_batch([data['text'] for _, data in rows], 50)
+            for (i, data), prompt in zip(rows, prompts):
+                yield i, (data, prompt)
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', default='./oscar.jsonl')
+    parser.add_argument('--output', default='./oscar_ai_added.jsonl')
+    parser.add_argument('--concurrency', type=int, default=8, help='同時に投げるリクエスト数')
+    parser.add_argument('--rpm', type=int, default=3500, help='1分あたりのリクエスト数の上限')
+    parser.add_argument('--tpm', type=int, default=90000, help='1分あたりのトークン数の上限')
+    parser.add_argument('--max_retries', type=int, default=5)
+    parser.add_argument('--start_line', type=int, default=None, help='指定しなければ出力済みの行数から再開する')
+    parser.add_argument('--api_base', default=None, help='mock serverなどに向ける場合に指定')
+    parser.add_argument('--stub', action='store_true', help='APIを呼ばずにダミーの文章を生成する')
+    parser.add_argument('--cache', default='./oscar_generate_cache.sqlite', help='APIの応答を保存するSQLiteファイル。空文字でcacheしない')
+    parser.add_argument('--rebuild', action='store_true', help='APIを呼ばずにcacheだけから出力ファイルを最初から作り直す')
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    input_file_path = args.input
+    output_file_path = args.output
+
+    # 途中から実行するための設定
+    # 指定がなければ出力済みの行の次から追記する
+    start_line = args.start_line if args.start_line is not None else count_lines(output_file_path)
+    if args.rebuild:
+        start_line = 0
+    if start_line > 0:
+        print(f"{start_line}行目から再開します")
+    mode = 'a' if start_line > 0 else 'w'
+
+    if args.stub:
+        client = StubChatClient()
+    else:
+        client = OpenAIChatClient(api_base=args.api_base)
+    if args.rebuild:
+        if not args.cache:
+            raise ValueError('--rebuild requires --cache')
+        client = CacheOnlyClient(client.params())
+    cache = ResponseCache(args.cache) if args.cache else None
+
+    with open(output_file_path, mode, encoding='utf-8') as outfile:
+        def on_result(index, row, ai_text):
+            data, _ = row
+            # 新しいフィールドを追加
+            data['gpt-3.5-turbo_generated_text_wo_prompt'] = get_N_tokens(ai_text, 512)
+            # JSON形式で出力
+            json.dump(data, outfile, ensure_ascii=False)
+            outfile.write('\n')
+            outfile.flush()
+
+        asyncio.run(generate_all(
+            read_rows(input_file_path, start_line),
+            lambda row: build_messages(row[1]),
+            client,
+            on_result,
+            concurrency=args.concurrency,
+            request_bucket=TokenBucket(args.rpm),
+            token_bucket=TokenBucket(args.tpm),
+            count_tokens=count_tokens,
+            completion_tokens=1024,
+            max_retries=args.max_retries,
+            cache=cache,
+        ))
+    if cache is not None:
+        cache.close()
+    print(f"AI生成テキストが {output_file_path} に保存されました。")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import os
+import json
+
+
+## Parquetで書くときの列の型 (ここにない列はpyarrowに推定させる)
+COLUMN_TYPES = {
+    'text': 'string',
+    'quality_warnings': 'list<string>',
+    'perplexity': 'float64',
+}
+
+
+def arrow_type(name):
+    import pyarrow as pa
+    if name.startswith('list<'):
+        return pa.list_(arrow_type(name[len('list<'):-1]))
+    return getattr(pa, name)()
+
+
+def arrow_schema(columns):
+    import pyarrow as pa
+    return pa.schema([(column, arrow_type(COLUMN_TYPES.get(column, 'string'))) for column in columns])
+
+
+class JSONLWriter():
+    ## 1行1レコードのJSONで書く。columnsを指定するとその列だけを書く
+    def __init__(self, path, columns=None, append=False):
+        self.path = path
+        self.columns = columns
+        self.fp = open(path, 'ab' if append else 'wb')
+
+    def write(self, record):
+        if self.columns is not None:
+            record = {column: record.get(column) for column in self.columns}
+        self.write_raw(json.dumps(record, ensure_ascii=False))
+
+    def write_raw(self, line):
+        ## JSONに変換済みの行をそのまま書く
+        self.fp.write((line + '\n').encode('utf-8'))
+
+    def tell(self):
+        return self.fp.tell()
+
+    def sync(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def close(self):
+        self.sync()
+        self.fp.close()
+
+
+class ParquetWriter():
+    ## batch_rows件ごとにrow groupとして書く (pyarrowが必要)
+    ## 途中まで書いたファイルに追記はできないので、tell()はNoneを返す
+    def __init__(self, path, columns, batch_rows=10000):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('pyarrow is required to write parquet: pip install pyarrow')
+        self.path = path
+        self.columns = columns
+        self.batch_rows = batch_rows
+        self.schema = arrow_schema(columns)
+        self.writer = pq.ParquetWriter(path, self.schema, compression='zstd')
+        self.rows = []
+
+    def write(self, record):
+        self.rows.append(record)
+        if len(self.rows) >= self.batch_rows:
+            self.flush()
+
+    def write_raw(self, line):
+        self.write(json.loads(line))
+
+    def flush(self):
+        import pyarrow as pa
+        if self.rows:
+            table = pa.Table.from_pylist([{column: row.get(column) for column in self.columns} for row in self.rows],
+                                         schema=self.schema)
+            self.writer.write_table(table)
+            self.rows = []
+
+    def tell(self):
+        return None
+
+    def sync(self):
+        self.flush()
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def detect_format(path):
+    return 'parquet' if path.endswith('.parquet') else 'jsonl'
+
+
+def open_writer(path, columns=None, format=None, append=False, batch_rows=10000):
+    format = format or detect_format(path)
+    if format == 'parquet':
+        if append:
+            raise ValueError('cannot append to a parquet file')
+        return ParquetWriter(path, columns or ['text'], batch_rows=batch_rows)
+    if format == 'jsonl':
+        return JSONLWriter(path, columns, append=append)
+    raise ValueError(f'unknown output format: {format}')
+
+
+def read_records(path, columns=None, batch_size=10000, row_groups=None):
+    ## .parquetなら必要な列だけをmemory mapで読み、.jsonlなら1行ずつ読んでcolumnsの列を取り出す
+    ## row_groupsを指定すると.parquetのそのrow groupだけを読む
+    if detect_format(path) == 'parquet':
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path, memory_map=True)
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns, row_groups=row_groups):
+            yield from batch.to_pylist()
+        return
+    from jsonl_reader import iter_lines
+    for line in iter_lines(path):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if columns is not None:
+            record = {column: record.get(column) for column in columns}
+        yield record
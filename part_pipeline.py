@@ -0,0 +1,87 @@
+import queue
+import threading
+import traceback
+
+STOP = object()
+
+
+class Stage():
+    ## batch_size > 1 のstageは、その時点で待っているitemを最大batch_size個まとめて
+    ## funcにlistで渡す (funcは同じ長さのlistを返す)
+    def __init__(self, name, func, num_workers=1, batch_size=1):
+        self.name = name
+        self.func = func
+        self.num_workers = max(1, num_workers)
+        self.batch_size = max(1, batch_size)
+
+
+def run_pipeline(items, stages, queue_size=1):
+    ## 各stageをthreadで動かし、stage間はサイズ制限付きのqueueでつなぐ
+    ## 例えば fetch -> filter -> upload なら、part iのfilter中に
+    ## part i+1の取得とpart i-1のuploadが同時に進む
+    ## 失敗したitemはそこで止めて、(item, stage名, error) をfailuresに記録する
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    results = []
+    failures = []
+    lock = threading.Lock()
+
+    def feed():
+        for item in items:
+            queues[0].put((item, item))
+        queues[0].put(STOP)
+
+    def work(idx, stage, remaining):
+        in_q, out_q = queues[idx], queues[idx + 1]
+        while True:
+            task = in_q.get()
+            if task is STOP:
+                ## 同じstageの他のworkerにも終了を伝え、最後の1つが次のstageへ伝える
+                in_q.put(STOP)
+                with lock:
+                    remaining[0] -= 1
+                    is_last = remaining[0] == 0
+                if is_last:
+                    out_q.put(STOP)
+                return
+            tasks = [task]
+            while len(tasks) < stage.batch_size:
+                try:
+                    task = in_q.get_nowait()
+                except queue.Empty:
+                    break
+                if task is STOP:
+                    in_q.put(STOP)
+                    break
+                tasks.append(task)
+            items = [item for item, _ in tasks]
+            try:
+                print(f'[{stage.name}] start', *items)
+                if stage.batch_size > 1:
+                    values = stage.func([value for _, value in tasks])
+                else:
+                    values = [stage.func(tasks[0][1])]
+                print(f'[{stage.name}] done', *items)
+            except Exception as e:
+                traceback.print_exc()
+                with lock:
+                    failures.extend((item, stage.name, e) for item in items)
+                continue
+            for item, value in zip(items, values):
+                out_q.put((item, value))
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for idx, stage in enumerate(stages):
+        remaining = [stage.num_workers]
+        for _ in range(stage.num_workers):
+            threads.append(threading.Thread(target=work, args=(idx, stage, remaining), daemon=True))
+    for t in threads:
+        t.start()
+
+    while True:
+        task = queues[-1].get()
+        if task is STOP:
+            break
+        results.append(task)
+    for t in threads:
+        t.join()
+    return results, failures
@@ -1,35 +1,80 @@
 import json
 import os
+import re
 import sys
 import gc
+import itertools
+import contextlib
 from typing import Any
 from tqdm import tqdm
 import unicodedata
 import psutil
 import argparse
+import numpy as np
 
-from hojichar import Compose, document_filters, deduplication, Parallel, Document
+from hojichar import document_filters, Document
 from hojichar.filters.document_filters import JSONLoader
 from hojichar.core.filter_interface import Filter
 
-from huggingface_hub import hf_hub_download
 import time
 
+from jsonl_reader import iter_lines_with_offset, iter_zst_lines_with_offset
+from manifest import Manifest, file_fingerprint
+from batch_pipeline import BatchCompose, BatchParallel, Reorderable
+from part_pipeline import Stage, run_pipeline
+from storage_backends import HFHubFetcher, LocalDirFetcher, HFHubUploader, LocalDirUploader
+from upload_to_hf import compress_file_with_zst, verify_zst
+from retry_utils import retry
+from keyword_matcher import KeywordMatcher
+from output_writer import open_writer, detect_format
+from signal_store import SignalWriter, doc_signals, signals_path
+
 class OscarDocument(Document):
       def __init__(self, *args, **kwargs):
           super().__init__(*args, **kwargs)          
           self.metadata = {}
 
+class CharStats(Filter):
+    ## 文字数やスペースの数などをまとめて1回計算し、doc.char_statsに付けておく
+    ## 通常はchar_stats(doc)が必要になった時点 (SpaceFilter) で計算するので、長さなどで先にrejectされた文書は数えない
+    ## (Pythonで1文字ずつ数えるよりstr.countの方がずっと速いので、各値はstr.countで数える)
+    ## signals=Trueなら改行の数とひらがな・カタカナ・漢字の割合も計算する (signal_store.pyに保存する場合)
+    ## signal storeには全文書の値が必要なので、その場合はbuild_cleanerでloaderの直後に置く
+    ## 日本語の文字は、連続をまとめて消した長さとの差で数える (1文字ずつ文字列を作らない)
+    japanese_pattern = re.compile(r'[\u3040-\u30ff\u4e00-\u9fff]+')
+
+    def __init__(self, signals=False, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.signals = signals
+
+    def apply(self, doc):
+        text = doc.text
+        doc.char_stats = {
+            'length': len(text),
+            'half_space': text.count(' '),
+            'full_space': text.count('　'),
+        }
+        if self.signals:
+            doc.char_stats['newline'] = text.count('\n')
+            doc.char_stats['japanese_ratio'] = (len(text) - len(self.japanese_pattern.sub('', text))) / len(text) if text else 0.0
+        doc.char_stats_text = text
+        return doc
+
+def char_stats(doc):
+    ## CharStatsを通っていない、または途中でtextが書き換えられた場合はここで計算する
+    if getattr(doc, 'char_stats_text', None) is not doc.text:
+        CharStats().apply(doc)
+    return doc.char_stats
+
 class SpaceFilter(Filter):
     def apply(self, doc):        
         space_count = 20
-        text = doc.text
-        if(len(text) > 100):
+        stats = char_stats(doc)
+        if(stats['length'] > 100):
             ## 半角スペース or 全角スペースを多く含む
-            if(text.count(' ') > space_count or text.count('　') > space_count):
+            if(stats['half_space'] > space_count or stats['full_space'] > space_count):
                 doc.is_rejected = True
 
-        doc.text = text
         return doc
         
 class FilterByQualityWarnings(Filter):
@@ -48,29 +93,118 @@ class FilterByQualityWarnings(Filter):
             
         return doc    
 
-class PPLFilter(Filter):
-    def __init__(self, model_path, sp_model_path, ppl_th, *args: Any, **kwargs: Any) -> None:
-        import kenlm
-        import sentencepiece        
+class NgWordsFilter(Filter):
+    ## NgWordsFilterJaと同じ判定を、キーワードをtrieにまとめた正規表現で1回の走査で行う
+    def __init__(self, dict_path, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.matcher = KeywordMatcher.from_file(dict_path)
+
+    def apply(self, doc):
+        match = self.matcher.search(doc.text)
+        if match:
+            doc.is_rejected = True
+            self.matched_text = match.group()
+        return doc
+
+class NormalizeAndMask(Filter):
+    ## DocumentNormalizer (NFKC) とMaskPersonalInformationを1つにまとめたもの (結果は同じ)
+    ## 電話番号・メールアドレスのpatternは改行をまたがないので、行ごとに
+    ##   - ASCIIだけの行はNFKCで変わらないので正規化しない
+    ##   - '0'も'+'もない行は電話番号に、'@'がない行はメールアドレスにmatchしないので置換しない
+    ## として、文書全体に正規表現をかけるのを避ける (NFKCも改行をまたいで合成することはない)
+    ## patternはclass変数なのでimport時に1回だけcompileされ、fork後のworkerでも共有される
+    phone_pat = re.compile(
+        r"((0|\+\d{1,3}[- ]?)(\d{2}[- ]?\d{4}[- ]?|\d[- ]?\d{4}[- ]?|\d{2}[- ]?\d{3}[- ]?|\d{3}[- ]?\d{2}[- ]?|\d{4}[- ]?\d{1}[- ]?))\d{4}"  # noqa
+    )
+    email_pat = re.compile(
+        r"[a-zA-Z0-9!#$%&'*+\-/=?^_`{|}~.]+@[A-Za-z0-9!#$%&'*+\-/=?^_`{|}~.]+(\.[A-Za-z0-9\-]+)"  # noqa
+    )
+
+    def normalize_line(self, line):
+        if not line.isascii():
+            line = unicodedata.normalize('NFKC', line)
+        if '0' in line or '+' in line:
+            line = self.phone_pat.sub(r"\1XXXX", line)
+        if '@' in line:
+            line = self.email_pat.sub(r"xxxx@yyy\1", line)
+        return line
+
+    def apply(self, doc):
+        doc.text = '\n'.join([self.normalize_line(line) for line in doc.text.split('\n')])
+        return doc
 
+def load_kenlm(model_path, load_method=None):
+    ## load_method: 'lazy' (mmapして必要なページだけ読む)、'populate' (mmapして先に全体を読む)、'read' (mallocして読む)
+    ## lazy・populateはpage cacheをそのまま使うので、同じモデルを読む複数のプロセスでメモリを共有できる
+    ## (.arpaはmmapできないので常にread。binaryに変換したものを使う)
+    import kenlm
+    if load_method is None:
+        return kenlm.LanguageModel(model_path)
+    config = kenlm.Config()
+    config.load_method = {
+        'lazy': kenlm.LoadMethod.LAZY,
+        'populate': kenlm.LoadMethod.POPULATE_OR_READ,
+        'read': kenlm.LoadMethod.READ,
+    }[load_method]
+    return kenlm.LanguageModel(model_path, config)
+
+class PPLFilter(Filter):
+    def __init__(self, model_path, sp_model_path, ppl_th, max_chars=None, max_sentences=None, model=None, sp=None,
+                 load_method=None, *args: Any, **kwargs: Any) -> None:
         super().__init__(*args, **kwargs)
         self.ppl_th = ppl_th
-        self.model = kenlm.LanguageModel(model_path)
-        self.sp = sentencepiece.SentencePieceProcessor()
-        self.sp.load(sp_model_path)
+        ## 長い文章は先頭max_chars文字、または均等に選んだmax_sentences文だけで採点する
+        self.max_chars = max_chars
+        self.max_sentences = max_sentences
+        ## model、spを渡した場合はファイルから読み込まない (benchmark.pyのstubなど)
+        ## build_cleanerは親プロセスで呼ぶので、モデルはfork前に1回だけ読み込まれworker間で共有される
+        if model is None:
+            model = load_kenlm(model_path, load_method)
+        if sp is None:
+            import sentencepiece
+            sp = sentencepiece.SentencePieceProcessor()
+            sp.load(sp_model_path)
+        self.model = model
+        self.sp = sp
+
+    def sample_text(self, text):
+        if self.max_sentences is not None:
+            sentences = [s for s in re.split(r'(?<=[。！？\n])', text) if s.strip()]
+            if len(sentences) > self.max_sentences:
+                step = len(sentences) / self.max_sentences
+                sentences = [sentences[int(i * step)] for i in range(self.max_sentences)]
+            text = ''.join(sentences)
+        if self.max_chars is not None:
+            text = text[:self.max_chars]
+        return unicodedata.normalize('NFD', text)
 
     def apply(self, document):
-        text = document.text
-        text = unicodedata.normalize('NFD', text)
+        text = self.sample_text(document.text)
         toks = self.sp.encode(text, out_type=str)
         
         sentence = " ".join(toks)
         ppl = self.model.perplexity(sentence)
+        document.perplexity = ppl
         if ppl > self.ppl_th:
             # print(ppl, document.text)
             document.is_rejected = True
         return document
 
+    def apply_batch(self, documents):
+        ## sentencepieceはbatchでencodeし、閾値の判定はnumpyでまとめて行う
+        ## (kenlmにはbatch APIがないため採点は1文ずつ)
+        texts = [self.sample_text(doc.text) for doc in documents]
+        toks = self.sp.encode(texts, out_type=str)
+        ppls = np.fromiter(
+            (self.model.perplexity(" ".join(t)) for t in toks),
+            dtype=np.float64, count=len(documents)
+        )
+        for doc, ppl in zip(documents, ppls.tolist()):
+            doc.perplexity = ppl
+        for i in np.flatnonzero(ppls > self.ppl_th):
+            documents[i].is_rejected = True
+        return documents
+
 class OscarJSONLoader(JSONLoader):
     def __init__(self, metadata_keys = [], *args: Any, **kwargs: Any) -> None:
         super().__init__(*args, **kwargs)
@@ -114,30 +248,29 @@ class Timer(Filter):
         print('time: ', time.time() - self.start)
         return document
     
-def extract_zst_file(input_file, output_file):
-    import zstandard as zstd
-    with open(input_file, 'rb') as compressed_file:
-        decompressor = zstd.ZstdDecompressor()
-        with decompressor.stream_reader(compressed_file) as reader, open(output_file, 'wb') as output:
-            while True:
-                chunk = reader.read(16384)
-                if not chunk:
-                    break
-                output.write(chunk)
-                del chunk
-        del reader
-        del output
-    del compressed_file
-    gc.collect()
+def read_yielder(input_file, start=0, end=None, on_progress=None):
+    ## ファイル全体を読み込まず、[start, end) の範囲を少しずつ読む
+    ## end_offsetはcheckpointに記録する、この行を読み終えた位置
+    for offset, line in iter_lines_with_offset(input_file, start=start, end=end, on_progress=on_progress):
+        doc = OscarDocument(line.decode('utf-8'))
+        doc.end_offset = offset + len(line)
+        doc.num_bytes = len(line)
+        yield doc
 
-def read_yielder(input_file):
-    cnt = 0
-    with open(input_file) as fp:        
-        for line in fp.readlines():
-            # if cnt > 10000:
-            #     break
-            cnt += 1
-            yield OscarDocument(line)
+def read_zst_yielder(input_file, t, start=0):
+    ## 展開したファイルをディスクに書かずに、展開しながらDocumentを渡す
+    for offset, line in iter_zst_lines_with_offset(input_file, start=start, on_progress=t.update):
+        doc = OscarDocument(line.decode('utf-8'))
+        doc.end_offset = offset + len(line)
+        doc.num_bytes = len(line)
+        yield doc
+
+def report_path(output_file):
+    return os.path.splitext(output_file)[0] + '.stats.json'
+
+def write_report(path, report):
+    with open(path, 'w', encoding='utf-8') as fp:
+        json.dump(report, fp, ensure_ascii=False, indent=2)
 
 def show_diff_mem(num, start):
     def format(size):
@@ -151,54 +284,197 @@ def show_diff_mem(num, start):
     # print(num, format(psutil.virtual_memory().used - start))
     print(num, format(psutil.virtual_memory().used))
 
-def clean(input_file, output_file, num_jobs=10):
+def build_cleaner(ppl_max_chars=None, ppl_max_sentences=None, ppl_model=None, ppl_sp=None, dump_json=True,
+                  signals=False, kenlm_load_method=None, profile=False):
+    ## dump_json=Falseならtextを{"text": ...}に変換せずに返す (Parquetで列ごとに書く場合)
     key = 'text'
     key = 'content'
-    # before_debup_file = './data/before_debup.jsonl'
-    before_debup_file = output_file
-    start = psutil.virtual_memory().used
-
-    cleaner = Compose([
+    filters = [
         OscarJSONLoader(key=key, metadata_keys=['quality_warnings']),
-        document_filters.DocumentLengthFilter(min_doc_len=500, max_doc_len=50000),
-        document_filters.AcceptJapanese(),
-        FilterByQualityWarnings(),
-        SpaceFilter(),
-        document_filters.NgWordsFilterJa(dict_path='./ng_word.txt'),
-        document_filters.DiscardBBSComments(),
-        document_filters.DiscardAds(),
-        document_filters.DocumentNormalizer(),
-        document_filters.MaskPersonalInformation(),
+        ## rejectするだけのfilterは順序を入れ替えてもよい
+        Reorderable([
+            document_filters.DocumentLengthFilter(min_doc_len=500, max_doc_len=50000),
+            document_filters.AcceptJapanese(),
+            FilterByQualityWarnings(),
+            SpaceFilter(),
+            NgWordsFilter(dict_path='./ng_word.txt'),
+            document_filters.DiscardBBSComments(),
+            document_filters.DiscardAds(),
+        ]),
+        ## 正規化・マスクはrejectするだけのfilterをすべて通った文書にだけ行う
+        ## (PPLFilterは正規化・マスク後のtextで採点するので、その前に置く)
+        NormalizeAndMask(),
         PPLFilter(
                 model_path='./models/ja.arpa.bin',
                 sp_model_path='./models/ja.sp.model',
-                ppl_th=90000
+                ppl_th=90000,
+                max_chars=ppl_max_chars,
+                max_sentences=ppl_max_sentences,
+                model=ppl_model,
+                sp=ppl_sp,
+                load_method=kenlm_load_method
         ),
-        document_filters.JSONDumper()
-    ])
+    ]
+    if signals:
+        ## signal storeに全文書の文字数などを残すため、rejectするfilterより前で計算する
+        filters.insert(1, CharStats(signals=True))
+    if dump_json:
+        filters.append(document_filters.JSONDumper())
+    return BatchCompose(filters, profile=profile)
+
+## Parquetで出力するときの列
+PARQUET_COLUMNS = ['text', 'quality_warnings', 'perplexity']
+
+def output_record(doc):
+    return {
+        'text': doc.text,
+        'quality_warnings': doc.metadata.get('quality_warnings'),
+        'perplexity': getattr(doc, 'perplexity', None),
+    }
+
+def clean(input_file, output_file, num_jobs=10, batch_size=64, ppl_max_chars=None, ppl_max_sentences=None,
+          adaptive_order=False, warmup_docs=1000, manifest=None, part=None, checkpoint_interval=10000,
+          ppl_model=None, ppl_sp=None, output_format=None, signals=False, kenlm_load_method=None,
+          max_inflight=None, memory_limit=None, profile=False, parallel=None):
+    # before_debup_file = './data/before_debup.jsonl'
+    before_debup_file = output_file
+    start = psutil.virtual_memory().used
+
+    ## output_format: 'jsonl' or 'parquet' (指定しなければoutput_fileの拡張子で決める)
+    ## parquetではtext・quality_warnings・perplexityを列として書く
+    output_format = output_format or detect_format(output_file)
+    ## signals=Trueなら、全文書のperplexity・文字数などを{output}.signals.npyに保存する
+    ## 閾値を変えるときはsignal_store.pyで出力から選び直せる
+    ## parallelを渡した場合は、そのBatchParallelのworker (forkしたときのfilter) を使う
+    ## (filterの設定とnum_jobsなどのpoolの設定は作ったときのものになる)
+    if parallel is None:
+        cleaner = build_cleaner(ppl_max_chars, ppl_max_sentences, ppl_model, ppl_sp,
+                                dump_json=output_format == 'jsonl', signals=signals,
+                                kenlm_load_method=kenlm_load_method, profile=profile)
+    else:
+        cleaner = parallel.filter
+        cleaner.reset_stats()
     
     print('-- start clean --')
     cnt = 0
+    total_docs = 0
+
+    ## 出力は一時ファイルに書き、最後まで処理できたらrenameする
+    ## manifestがあれば一定件数ごとに入力のoffsetと出力のbyte数を記録し、次回はそこから再開する
+    part = os.path.basename(output_file) if part is None else part
+    tmp_output_file = output_file + '.part'
+    ## parquetは書きかけのファイルに追記できないので、途中からの再開はjsonlのみ
+    resume_offset = 0
+    append = False
+    signals_file = signals_path(output_file)
+    if manifest is not None:
+        input_hash = file_fingerprint(input_file)
+        if manifest.is_done(part, 'filter', input_hash):
+            print('skip finished part', part)
+            return
+        entry = manifest.get(part, 'filter')
+        if (output_format == 'jsonl' and entry.get('input_hash') == input_hash
+                and entry.get('output_bytes') is not None and os.path.exists(tmp_output_file)
+                and (not signals or os.path.exists(signals_file + '.part'))):
+            resume_offset = entry['offset']
+            cnt = entry['kept_docs']
+            total_docs = entry['total_docs']
+            with open(tmp_output_file, 'r+b') as fp:
+                fp.truncate(entry['output_bytes'])
+            append = True
+            print('resume from offset', resume_offset)
+        else:
+            manifest.reset(part, 'filter',
+                           input=input_file,
+                           input_hash=input_hash,
+                           output=output_file,
+                           offset=0,
+                           output_bytes=0,
+                           kept_docs=0,
+                           total_docs=0,
+                           done=False)
 
-    total_lines = 0
     show_diff_mem(0.5, start)
-    with open(input_file, 'r', encoding='utf-8') as file:
-        total_lines = sum(1 for _ in file)
+    ## 進捗はbyte数(.zstなら圧縮後)で表示する (行数を数えるための事前の読み込みはしない)
+    t = tqdm(total=os.path.getsize(input_file), unit='B', unit_scale=True)
+    if input_file.endswith('.zst'):
+        docs = read_zst_yielder(input_file, t, start=resume_offset)
+    else:
+        t.update(resume_offset)
+        docs = read_yielder(input_file, start=resume_offset, on_progress=t.update)
+    if adaptive_order:
+        ## 先頭warmup_docs件で計測して並べ替え (計測に使った分も通常どおり処理する)
+        sample = list(itertools.islice(docs, warmup_docs))
+        ordering = cleaner.reorder(sample)
+        for group in ordering:
+            print('filter order:', [info['name'] for info in group])
+        docs = itertools.chain(sample, docs)
     gc.collect()
     show_diff_mem(1, start)
 
-    print('raw data len ', total_lines)
-    t = tqdm(total=total_lines)
-    with Parallel(cleaner, num_jobs=num_jobs) as pfilter:
+    start_time = time.time()
+    offset = resume_offset
+
+    def checkpoint(writer, done=False):
+        writer.sync()
+        if signal_writer is not None:
+            signal_writer.sync()
+        if manifest is not None:
+            manifest.update(part, 'filter',
+                            offset=offset,
+                            output_bytes=writer.tell(),
+                            kept_docs=cnt,
+                            total_docs=total_docs,
+                            done=done)
+
+    if parallel is None:
+        parallel_context = BatchParallel(cleaner, num_jobs=num_jobs, batch_size=batch_size,
+                                         max_inflight=max_inflight, memory_limit=memory_limit)
+    else:
+        ## 呼び出し側で作ったpoolは閉じない
+        parallel_context = contextlib.nullcontext(parallel)
+    with parallel_context as pfilter:
         show_diff_mem(2, start)
-        with open(before_debup_file, "w") as fp:
-            for doc in pfilter.imap_apply(read_yielder(input_file)):
-                if not doc.is_rejected:
-                    fp.write(doc.text + "\n")
-                    cnt += 1
-                del doc
-                t.update(1)
+        writer = open_writer(tmp_output_file, columns=PARQUET_COLUMNS, format=output_format, append=append)
+        signal_writer = SignalWriter(signals_file, total_docs if append else None) if signals else None
+        ## BatchParallelは入力順に結果を返すので、offsetまでの行はすべて書き込み済み
+        for doc in pfilter.imap_apply(docs):
+            output_offset = writer.tell()
+            if not doc.is_rejected:
+                if output_format == 'jsonl':
+                    writer.write_raw(doc.text)
+                else:
+                    writer.write(output_record(doc))
+                cnt += 1
+            if signal_writer is not None:
+                if doc.is_rejected:
+                    signal_writer.write(doc_signals(doc, offset))
+                else:
+                    signal_writer.write(doc_signals(doc, offset, cnt - 1, -1 if output_offset is None else output_offset,
+                                                   0 if output_offset is None else writer.tell() - output_offset))
+            offset = doc.end_offset
+            del doc
+            total_docs += 1
+            if total_docs % checkpoint_interval == 0:
+                checkpoint(writer)
+        writer.close()
+        if signal_writer is not None:
+            signal_writer.close()
         t.close()
+    os.replace(tmp_output_file, before_debup_file)
+    if manifest is not None:
+        manifest.update(part, 'filter', offset=offset, kept_docs=cnt, total_docs=total_docs, done=True)
+    print('raw data len ', total_docs)
+    write_report(report_path(output_file), {
+        'input': input_file,
+        'output': output_file,
+        'total_docs': total_docs,
+        'kept_docs': cnt,
+        'elapsed': time.time() - start_time,
+        ## profile=Trueの場合のみfilterごとの処理時間などを記録する
+        'filters': cleaner.stats if profile else None,
+        'ordering': cleaner.ordering,
+    })
     show_diff_mem(4, start)
     print('end data len: ', cnt)
     gc.collect()
@@ -211,49 +487,137 @@ def get_args():
     parser.add_argument('--end', type=int, default=119)
     parser.add_argument('--output', type=str)
     parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--ppl_max_chars', type=int, default=None)
+    parser.add_argument('--ppl_max_sentences', type=int, default=None)
+    parser.add_argument('--adaptive_order', action='store_true')
+    parser.add_argument('--warmup_docs', type=int, default=1000)
+    parser.add_argument('--source_dir', type=str, default='')
+    parser.add_argument('--upload_repo', type=str, default='')
+    parser.add_argument('--upload_dir', type=str, default='')
+    parser.add_argument('--fetch_workers', type=int, default=1)
+    parser.add_argument('--upload_workers', type=int, default=1)
+    parser.add_argument('--max_retries', type=int, default=5, help='アップロードに失敗したときの再試行の回数')
+    parser.add_argument('--queue_size', type=int, default=1)
+    parser.add_argument('--manifest', type=str, default='')
+    parser.add_argument('--checkpoint_interval', type=int, default=10000)
+    parser.add_argument('--zst_level', type=int, default=3)
+    parser.add_argument('--zst_threads', type=int, default=-1)
+    parser.add_argument('--zst_frame_size', type=int, default=None)
+    parser.add_argument('--output_format', type=str, default='jsonl', choices=['jsonl', 'parquet'])
+    parser.add_argument('--signals', action='store_true')
+    parser.add_argument('--profile', action='store_true', help='filterごとの処理時間・件数を{i}.stats.jsonに記録する')
+    parser.add_argument('--kenlm_load', type=str, default=None, choices=['lazy', 'populate', 'read'])
+    parser.add_argument('--max_inflight', type=int, default=None, help='先読みするbatch数の上限 (デフォルトはworkers*2)')
+    parser.add_argument('--memory_limit', type=float, default=None, help='メモリ使用量の上限 (GB)')
     args = parser.parse_args()
     return args
 
 
+def get_fetcher(args):
+    if args.source_dir:
+        return LocalDirFetcher(args.source_dir)
+    return HFHubFetcher(repo_id='oscar-corpus/OSCAR-2301',
+                        subfolder='ja_meta',
+                        local_dir='./data',
+                        token=os.environ['HF_TOKEN'])
+
+def get_uploader(args):
+    if args.upload_dir:
+        return LocalDirUploader(args.upload_dir)
+    if args.upload_repo:
+        return HFHubUploader(args.upload_repo, token=os.environ.get('HF_TOKEN'))
+    return None
+
 def main():
     args = get_args()
-    input_dir = './data'
     # output_dir = './output'
     output_dir = args.output
     print('output_dir...', output_dir)
-    token = os.environ['HF_TOKEN']
     start = args.start
     end = args.end
     
     num_jobs=args.workers
+    batch_size=args.batch_size
     print('start...')
     print(f'start: {start}')
     print(f'end: {end}')
     print(f'num_jobs: {num_jobs}')
 
-    for i in range(start, end+1):
-        url = f'https://huggingface.co/datasets/oscar-corpus/OSCAR-2301/resolve/main/ja_meta/ja_meta_part_{i}.jsonl.zst'
-        print('get...', url)
-        zst_file_name=os.path.basename(url)
-        hf_hub_download(repo_id='oscar-corpus/OSCAR-2301',
-                        subfolder='ja_meta',
-                        local_dir=input_dir,
-                        filename=zst_file_name,
-                        repo_type="dataset",
-                        token=token
-                        )
-        input_ex_file = input_dir + '/ja_meta/' + zst_file_name
-        jsonl_file = os.path.splitext(input_ex_file)[0]
+    fetcher = get_fetcher(args)
+    uploader = get_uploader(args)
+    ## 再実行時は完了済みのpart・stageを飛ばし、途中のpartは最後のcheckpointから再開する
+    manifest = Manifest(args.manifest or f'{output_dir}/manifest.json')
+
+    def fetch(i):
+        if manifest.is_done(i, 'filter'):
+            print('skip fetch, already filtered', i)
+            return i, None
+        zst_file_name = f'ja_meta_part_{i}.jsonl.zst'
+        print('get...', zst_file_name)
+        return i, fetcher.fetch(zst_file_name)
+
+    def process(fetched):
+        i, input_ex_file = fetched
         show_diff_mem(0, start)
-        extract_zst_file(input_ex_file, jsonl_file)
-        show_diff_mem(0.1, start)
-        output_file = f'{output_dir}/{i}.jsonl'
+        output_file = f'{output_dir}/{i}.{args.output_format}'
+        if input_ex_file is None:
+            return i, output_file
 
-        print('input...', jsonl_file)
+        print('input...', input_ex_file)
         print('output...', output_file)
-        clean(jsonl_file, output_file, num_jobs=num_jobs)
+        clean(input_ex_file, output_file, adaptive_order=args.adaptive_order, warmup_docs=args.warmup_docs,
+              manifest=manifest, part=i, checkpoint_interval=args.checkpoint_interval,
+              output_format=args.output_format, signals=args.signals, profile=args.profile,
+              parallel=parallel)
         gc.collect()
         show_diff_mem(8, start)
+        return i, output_file
+
+    def upload(processed):
+        i, output_file = processed
+        output_hash = file_fingerprint(output_file)
+        if manifest.is_done(i, 'upload', output_hash):
+            print('skip upload, already uploaded', i)
+            return manifest.get(i, 'upload')['remote']
+        if detect_format(output_file) == 'parquet':
+            ## parquetは列ごとにzstdで圧縮済みなので、そのままアップロードする
+            remote = retry(lambda: uploader.upload(output_file, os.path.basename(output_file)),
+                           max_retries=args.max_retries, name='upload')
+        else:
+            zst_file_path = output_file + '.zst'
+            frame_size = args.zst_frame_size << 20 if args.zst_frame_size else None
+            digest = compress_file_with_zst(output_file, zst_file_path, level=args.zst_level,
+                                            threads=args.zst_threads, frame_size=frame_size)
+            verify_zst(zst_file_path, digest)
+            remote = retry(lambda: uploader.upload(zst_file_path, os.path.basename(zst_file_path)),
+                           max_retries=args.max_retries, name='upload')
+            os.remove(zst_file_path)
+        manifest.reset(i, 'upload', input=output_file, input_hash=output_hash, remote=remote, done=True)
+        return remote
+
+    ## 取得・フィルタ・アップロードを別threadで並行に進める
+    ## filterは1つのpartをworkers個のプロセスで処理する (BatchParallelはプロセスで1つだけ) ので1 threadで順に処理する
+    stages = [
+        Stage('fetch', fetch, args.fetch_workers),
+        Stage('filter', process, 1),
+    ]
+    if uploader is not None:
+        stages.append(Stage('upload', upload, args.upload_workers))
+    ## workerはthreadを起動する前にmain threadで1度だけforkし、全partで使い回す
+    ## (fetch・uploadのthreadがlockを持ったままforkすると、子プロセスでdeadlockし得る)
+    cleaner = build_cleaner(args.ppl_max_chars, args.ppl_max_sentences,
+                            dump_json=args.output_format == 'jsonl', signals=args.signals,
+                            kenlm_load_method=args.kenlm_load, profile=args.profile)
+    with BatchParallel(cleaner, num_jobs=num_jobs, batch_size=batch_size, max_inflight=args.max_inflight,
+                       memory_limit=int(args.memory_limit * (1 << 30)) if args.memory_limit else None) as parallel:
+        results, failures = run_pipeline(range(start, end+1), stages, queue_size=args.queue_size)
+    print('done parts', sorted(i for i, _ in results))
+    for i, stage_name, e in failures:
+        print('failed part', i, stage_name, e)
+    ## 失敗したpartがあれば、呼び出し側 (cronやshellのloop) で分かるように0以外で終了する
+    if failures:
+        sys.exit(1)
 
 def test():
     clean('./sample2.jsonl', 'sample_output.jsonl')
@@ -0,0 +1,33 @@
+import json
+import sqlite3
+import hashlib
+
+
+def make_key(params, messages):
+    ## (model, max_tokensなどのparameter, prompt) のhashをkeyにする
+    payload = json.dumps({'params': params, 'messages': messages}, ensure_ascii=False, sort_keys=True)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class ResponseCache():
+    ## APIの応答をSQLiteに保存しておき、再実行時は同じリクエストをAPIに投げずに済ませる
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, params TEXT, text TEXT)')
+
+    def get(self, key):
+        row = self.conn.execute('SELECT text FROM responses WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key, params, text):
+        self.conn.execute('INSERT OR REPLACE INTO responses (key, params, text) VALUES (?, ?, ?)',
+                          (key, json.dumps(params, sort_keys=True), text))
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,20 @@
+import time
+import random
+
+
+def backoff_delay(attempt, base=1.0, max_delay=60.0):
+    ## exponential backoff + full jitter
+    return random.uniform(0, min(max_delay, base * (2 ** attempt)))
+
+
+def retry(func, max_retries=5, base_delay=2.0, max_delay=60.0, name='request'):
+    ## func()が例外を出したらbackoffしながらmax_retries回まで呼び直す
+    for attempt in range(max_retries):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == max_retries - 1:
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            print(f"{name} error: {e} (attempt {attempt+1}/{max_retries}), retry after {delay:.1f}s")
+            time.sleep(delay)
@@ -0,0 +1,78 @@
+import math
+import hashlib
+
+
+class SeenSet():
+    ## 完全一致で判定する通常のset
+    def __init__(self):
+        self.seen = set()
+
+    def add(self, item):
+        self.seen.add(item)
+
+    def add_if_absent(self, item):
+        if item in self.seen:
+            return False
+        self.seen.add(item)
+        return True
+
+    def __contains__(self, item):
+        return item in self.seen
+
+    def __len__(self):
+        return len(self.seen)
+
+    def get(self):
+        return list(self.seen)
+
+
+class BloomSeenSet():
+    ## 事前に決めたサイズのbit配列のみを使うBloom filter
+    ## 偽陽性(重複でないものを重複と判定)は error_rate 程度で起こり得る
+    def __init__(self, capacity=100_000_000, error_rate=1e-4):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(str(item).encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        self.add_if_absent(item)
+
+    def add_if_absent(self, item):
+        is_new = False
+        for pos in self._positions(item):
+            mask = 1 << (pos & 7)
+            if not self.bits[pos >> 3] & mask:
+                self.bits[pos >> 3] |= mask
+                is_new = True
+        if is_new:
+            self.count += 1
+        return is_new
+
+    def __contains__(self, item):
+        for pos in self._positions(item):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def memory_bytes(self):
+        return len(self.bits)
+
+
+def make_seen_set(kind='exact', capacity=100_000_000, error_rate=1e-4):
+    if kind == 'exact':
+        return SeenSet()
+    if kind == 'bloom':
+        return BloomSeenSet(capacity=capacity, error_rate=error_rate)
+    raise ValueError(f'unknown seen set: {kind}')
@@ -0,0 +1,216 @@
+import os
+import json
+import argparse
+
+import numpy as np
+
+## 1文書1行の固定長のrecord。.partには行をそのまま追記し、完了したら.npyにする
+SIGNAL_DTYPE = np.dtype([
+    ('offset', np.int64),           ## 入力ファイルでの行頭のoffset (.zstなら展開後)
+    ('end_offset', np.int64),
+    ('output_row', np.int64),       ## 出力での行番号 (残らなかった文書は-1)
+    ('output_offset', np.int64),    ## jsonlの出力での行頭のoffset (parquetや残らなかった文書は-1)
+    ('output_bytes', np.int64),
+    ('length', np.int32),           ## 以下はnormalize前のtextでの値
+    ('half_space', np.int32),
+    ('full_space', np.int32),
+    ('newline', np.int32),
+    ('japanese_ratio', np.float32),
+    ('perplexity', np.float64),     ## PPLFilterまで到達しなかった文書はNaN
+    ('quality_warnings', np.uint8), ## QUALITY_WARNINGSのbit
+    ('rejected_by', np.int8),       ## filter名の表 ({output}.signals.json) のindex (残った文書は-1)
+])
+
+QUALITY_WARNINGS = ['header', 'footer', 'noisy', 'tiny', 'short_sentences', 'adult']
+
+## build_cleanerのfilterの順 (CharStatsとJSONDumperは除く)
+## 書き出すときにこの表を.signals.jsonに保存し、読むときはその表でfilter名に戻す (表を変えても古いsignalを読める)
+REJECT_FILTERS = [
+    'OscarJSONLoader',
+    'DocumentLengthFilter',
+    'AcceptJapanese',
+    'FilterByQualityWarnings',
+    'SpaceFilter',
+    'NgWordsFilter',
+    'DiscardBBSComments',
+    'DiscardAds',
+    'NormalizeAndMask',
+    'PPLFilter',
+]
+
+## 閾値を変えて選び直せるfilter (signalだけで判定できるもの)
+THRESHOLD_FILTERS = ['DocumentLengthFilter', 'FilterByQualityWarnings', 'SpaceFilter', 'PPLFilter']
+
+
+def signals_path(output_file):
+    return os.path.splitext(output_file)[0] + '.signals.npy'
+
+
+def filters_path(signals_file):
+    ## rejected_byのfilter名の表
+    return os.path.splitext(signals_file)[0] + '.json'
+
+
+def quality_bits(warnings):
+    bits = 0
+    for warning in warnings or []:
+        if warning in QUALITY_WARNINGS:
+            bits |= 1 << QUALITY_WARNINGS.index(warning)
+    return bits
+
+
+def doc_signals(doc, start_offset, output_row=-1, output_offset=-1, output_bytes=0):
+    stats = getattr(doc, 'char_stats', None) or {}
+    rejected_by = getattr(doc, 'rejected_by', None) if doc.is_rejected else None
+    return (
+        start_offset,
+        doc.end_offset,
+        output_row,
+        output_offset,
+        output_bytes,
+        stats.get('length', 0),
+        stats.get('half_space', 0),
+        stats.get('full_space', 0),
+        stats.get('newline', 0),
+        stats.get('japanese_ratio', np.nan),
+        getattr(doc, 'perplexity', np.nan),
+        quality_bits(doc.metadata.get('quality_warnings')),
+        -1 if rejected_by is None else REJECT_FILTERS.index(rejected_by) if rejected_by in REJECT_FILTERS else len(REJECT_FILTERS),
+    )
+
+
+class SignalWriter():
+    ## signalを固定長のrecordとしてpath + '.part'に追記し、close()で.npyにする
+    ## 途中で落ちた場合は、checkpointで記録した行数までtruncateすれば再開できる
+    def __init__(self, path, resume_rows=None):
+        self.path = path
+        self.tmp_path = path + '.part'
+        self.rows = []
+        if resume_rows is None:
+            self.fp = open(self.tmp_path, 'wb')
+        else:
+            self.fp = open(self.tmp_path, 'r+b')
+            self.fp.truncate(resume_rows * SIGNAL_DTYPE.itemsize)
+            self.fp.seek(0, os.SEEK_END)
+
+    def write(self, record):
+        self.rows.append(record)
+
+    def sync(self):
+        if self.rows:
+            self.fp.write(np.array(self.rows, dtype=SIGNAL_DTYPE).tobytes())
+            self.rows = []
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def close(self):
+        self.sync()
+        self.fp.close()
+        signals = np.fromfile(self.tmp_path, dtype=SIGNAL_DTYPE)
+        ## 表を先に書き、.npyがあれば表もあるようにする
+        with open(filters_path(self.path) + '.tmp', 'w') as fp:
+            json.dump({'rejected_by': REJECT_FILTERS}, fp)
+        os.replace(filters_path(self.path) + '.tmp', filters_path(self.path))
+        with open(self.path + '.tmp', 'wb') as fp:
+            np.save(fp, signals)
+        os.replace(self.path + '.tmp', self.path)
+        os.remove(self.tmp_path)
+
+
+def load_signals(path):
+    return np.load(path, mmap_mode='r')
+
+
+def load_filter_names(path):
+    ## signalと一緒に保存したrejected_byのfilter名の表 (表がない古いsignalは今のREJECT_FILTERS)
+    if not os.path.exists(filters_path(path)):
+        return REJECT_FILTERS
+    with open(filters_path(path)) as fp:
+        return json.load(fp)['rejected_by']
+
+
+def threshold_mask(signals, min_doc_len=500, max_doc_len=50000, space_count=20,
+                   quality_warnings=('header', 'footer', 'noisy'), ppl_th=90000, min_japanese_ratio=None):
+    ## build_cleanerの閾値によるfilterと同じ判定をまとめて行う (Trueなら残す)
+    ## signalがない (NaN) 値は判定できないので通す
+    length = signals['length']
+    mask = (length >= min_doc_len) & (length <= max_doc_len)
+    mask &= ~((length > 100) & ((signals['half_space'] > space_count) | (signals['full_space'] > space_count)))
+    mask &= (signals['quality_warnings'] & quality_bits(quality_warnings)) == 0
+    mask &= ~(signals['perplexity'] > ppl_th)
+    if min_japanese_ratio is not None:
+        mask &= ~(signals['japanese_ratio'] < min_japanese_ratio)
+    return mask
+
+
+def select(signals, filter_names=REJECT_FILTERS, **thresholds):
+    ## 新しい閾値で残す文書と、閾値を緩めたために処理し直しが必要な文書を返す
+    ## filter_names: rejected_byのfilter名の表 (load_filter_namesで読む)
+    ## 出力に残っている文書からは選び直せるが、閾値のfilterでrejectされた文書はtextが残っていないので
+    ## (またはPPLFilterまで到達しておらずperplexityがないので) もう一度cleanする必要がある
+    ## (処理し直すと、まだ通していないNG wordなどのfilterでrejectされることもある)
+    mask = threshold_mask(signals, **thresholds)
+    kept = signals['output_row'] >= 0
+    threshold_codes = [code for code, name in enumerate(filter_names) if name in THRESHOLD_FILTERS]
+    recompute = mask & np.isin(signals['rejected_by'], threshold_codes)
+    return kept & mask, recompute
+
+
+def write_selection(output_file, signals, selected, new_output_file):
+    ## output_fileから選んだ行だけをnew_output_fileに書く (jsonlはbyte範囲をそのままコピー)
+    rows = signals[selected]
+    tmp_output_file = new_output_file + '.part'
+    if output_file.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(output_file, memory_map=True)
+        pq.write_table(table.take(np.sort(rows['output_row'])), tmp_output_file, compression='zstd')
+    else:
+        order = np.argsort(rows['output_offset'])
+        with open(output_file, 'rb') as infile, open(tmp_output_file, 'wb') as outfile:
+            for offset, size in zip(rows['output_offset'][order].tolist(), rows['output_bytes'][order].tolist()):
+                infile.seek(offset)
+                outfile.write(infile.read(size))
+    os.replace(tmp_output_file, new_output_file)
+    return len(rows)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, required=True, help='pre_filter.pyの出力 (.jsonl or .parquet)')
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--signals', type=str, default='', help='指定しなければ{input}.signals.npy')
+    ## デフォルトはbuild_cleanerと同じ閾値
+    parser.add_argument('--min_doc_len', type=int, default=500)
+    parser.add_argument('--max_doc_len', type=int, default=50000)
+    parser.add_argument('--space_count', type=int, default=20)
+    parser.add_argument('--quality_warnings', type=str, default='header,footer,noisy', help='rejectするquality_warnings (カンマ区切り)')
+    parser.add_argument('--ppl_th', type=float, default=90000)
+    parser.add_argument('--min_japanese_ratio', type=float, default=None)
+    parser.add_argument('--recompute_offsets', type=str, default='', help='処理し直しが必要な文書の入力offsetを書き出すファイル')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    signals_file = args.signals or signals_path(args.input)
+    signals = load_signals(signals_file)
+    selected, recompute = select(
+        signals,
+        filter_names=load_filter_names(signals_file),
+        min_doc_len=args.min_doc_len,
+        max_doc_len=args.max_doc_len,
+        space_count=args.space_count,
+        quality_warnings=[w for w in args.quality_warnings.split(',') if w],
+        ppl_th=args.ppl_th,
+        min_japanese_ratio=args.min_japanese_ratio,
+    )
+    kept = write_selection(args.input, signals, selected, args.output)
+    print(f'{len(signals)}件中{kept}件を残しました')
+    if recompute.any():
+        print(f'閾値を緩めたため{int(recompute.sum())}件はcleanし直す必要があります')
+        if args.recompute_offsets:
+            np.savetxt(args.recompute_offsets, signals['offset'][recompute], fmt='%d')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import os
+import shutil
+
+
+class HFHubFetcher():
+    def __init__(self, repo_id='oscar-corpus/OSCAR-2301', subfolder='ja_meta', local_dir='./data', token=None, repo_type='dataset'):
+        self.repo_id = repo_id
+        self.subfolder = subfolder
+        self.local_dir = local_dir
+        self.token = token
+        self.repo_type = repo_type
+
+    def fetch(self, filename):
+        from huggingface_hub import hf_hub_download
+        return hf_hub_download(repo_id=self.repo_id,
+                               subfolder=self.subfolder,
+                               local_dir=self.local_dir,
+                               filename=filename,
+                               repo_type=self.repo_type,
+                               token=self.token
+                               )
+
+
+class LocalDirFetcher():
+    ## テストなどでHugging Faceの代わりにローカルのディレクトリから取得する
+    def __init__(self, source_dir, local_dir=None):
+        self.source_dir = source_dir
+        self.local_dir = local_dir
+
+    def fetch(self, filename):
+        source_path = os.path.join(self.source_dir, filename)
+        if not os.path.exists(source_path):
+            raise FileNotFoundError(source_path)
+        if self.local_dir is None:
+            return source_path
+        os.makedirs(self.local_dir, exist_ok=True)
+        local_path = os.path.join(self.local_dir, filename)
+        shutil.copyfile(source_path, local_path)
+        return local_path
+
+
+class HFHubUploader():
+    def __init__(self, repo_id, token=None, repo_type='dataset'):
+        self.repo_id = repo_id
+        self.token = token
+        self.repo_type = repo_type
+
+    def upload(self, local_path, path_in_repo):
+        from huggingface_hub import upload_file
+        upload_file(
+            path_or_fileobj=local_path,
+            path_in_repo=path_in_repo,
+            repo_id=self.repo_id,
+            repo_type=self.repo_type,
+            token=self.token
+        )
+        return f'{self.repo_id}/{path_in_repo}'
+
+    def upload_many(self, files, commit_message=None):
+        ## 複数のファイルを1つのcommitでアップロードする
+        ## files: [(local_path, path_in_repo), ...]
+        from huggingface_hub import HfApi, CommitOperationAdd
+        operations = [CommitOperationAdd(path_in_repo=path_in_repo, path_or_fileobj=local_path)
+                      for local_path, path_in_repo in files]
+        HfApi(token=self.token).create_commit(
+            repo_id=self.repo_id,
+            repo_type=self.repo_type,
+            operations=operations,
+            commit_message=commit_message or f'Upload {len(files)} files'
+        )
+        return [f'{self.repo_id}/{path_in_repo}' for _, path_in_repo in files]
+
+
+class LocalDirUploader():
+    ## テストなどでHugging Faceの代わりにローカルのディレクトリへコピーする
+    def __init__(self, target_dir):
+        self.target_dir = target_dir
+
+    def upload(self, local_path, path_in_repo):
+        target_path = os.path.join(self.target_dir, path_in_repo)
+        os.makedirs(os.path.dirname(target_path) or '.', exist_ok=True)
+        shutil.copyfile(local_path, target_path + '.tmp')
+        os.replace(target_path + '.tmp', target_path)
+        return target_path
+
+    def upload_many(self, files, commit_message=None):
+        return [self.upload(local_path, path_in_repo) for local_path, path_in_repo in files]
@@ -1,51 +1,119 @@
 import os
-import time
+import sys
+import struct
+import hashlib
 import zstandard as zstd
-from huggingface_hub import upload_file
 import argparse
 
-def compress_file_with_zst(input_path, output_path):
-    with open(input_path, 'rb') as f_in:
-        with open(output_path, 'wb') as f_out:
-            cctx = zstd.ZstdCompressor()
-            compressor = cctx.stream_writer(f_out)
+from jsonl_reader import SKIPPABLE_MAGIC, SEEKABLE_MAGIC
+from manifest import Manifest, file_fingerprint
+from part_pipeline import Stage, run_pipeline
+from storage_backends import HFHubUploader, LocalDirUploader
+from retry_utils import retry
+
+def compress_file_with_zst(input_path, output_path, level=3, threads=-1, frame_size=None, buffer_size=1 << 22):
+    ## threads=-1ならCPU数分のthreadで圧縮する
+    ## frame_sizeを指定すると、行の途中で切らずにおよそframe_size byteごとに独立したframeにして
+    ## 末尾にseek tableを付ける (zstd seekable format)。jsonl_reader.split_zst_framesで分割して並列に読める
+    ## 返り値は元ファイルのhash (verify_zstで圧縮結果を確認するのに使う)
+    digest = hashlib.blake2b()
+    cctx = zstd.ZstdCompressor(level=level, threads=threads, write_checksum=True)
+    with open(input_path, 'rb') as f_in, open(output_path, 'wb') as f_out:
+        if frame_size is None:
+            compressor = cctx.stream_writer(f_out, write_size=buffer_size)
             while True:
-                chunk = f_in.read(65536)  # Read 64K at a time
+                chunk = f_in.read(buffer_size)
                 if not chunk:
                     break
+                digest.update(chunk)
                 compressor.write(chunk)
             compressor.flush(zstd.FLUSH_FRAME)
+        else:
+            frames = []
+
+            def write_frame(data):
+                compressed = cctx.compress(data)
+                f_out.write(compressed)
+                frames.append((len(compressed), len(data)))
+
+            ## 読んだchunkはbytearrayに追記し、frameはmemoryviewで切り出して圧縮する (frameごとにコピーしない)
+            pending = bytearray()
+            while True:
+                chunk = f_in.read(buffer_size)
+                if chunk:
+                    digest.update(chunk)
+                    pending += chunk
+                start = 0
+                while len(pending) - start >= frame_size or (not chunk and start < len(pending)):
+                    end = pending.rfind(b'\n', start, start + frame_size) + 1
+                    if end == 0:
+                        ## frame_sizeより長い行はその行の終わりで切る
+                        end = pending.find(b'\n', start + frame_size) + 1
+                    if end == 0:
+                        if chunk:
+                            break
+                        end = len(pending)
+                    with memoryview(pending) as view, view[start:end] as frame:
+                        write_frame(frame)
+                    start = end
+                ## 書き出した分はchunkを読むごとに1回だけまとめて捨てる
+                del pending[:start]
+                if not chunk:
+                    break
+            f_out.write(seek_table(frames))
+    return digest.hexdigest()
+
 
+def seek_table(frames):
+    ## zstd seekable formatのseek table (skippable frame)
+    ## frames: [(圧縮後のsize, 展開後のsize), ...]
+    entries = b''.join(struct.pack('<II', c, d) for c, d in frames)
+    footer = struct.pack('<IBI', len(frames), 0, SEEKABLE_MAGIC)
+    return struct.pack('<II', SKIPPABLE_MAGIC, len(entries) + len(footer)) + entries + footer
+
+
+def verify_zst(zst_path, expected_digest, buffer_size=1 << 22):
+    ## 展開した内容のhashが元ファイルと一致するかを確かめる
+    digest = hashlib.blake2b()
+    with open(zst_path, 'rb') as fp:
+        reader = zstd.ZstdDecompressor().stream_reader(fp, read_across_frames=True)
+        while True:
+            chunk = reader.read(buffer_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    if digest.hexdigest() != expected_digest:
+        raise ValueError(f'checksum mismatch after compression: {zst_path}')
+
+
+def get_uploader(args):
+    if args.upload_dir:
+        return LocalDirUploader(args.upload_dir)
+    return HFHubUploader(repo_id=f"{args.hf_username}/{args.dataset_name}",
+                         token=os.environ.get('HF_TOKEN'))
 
-def upload(input_file_path, hf_username, dataset_name):
-    zst_file_name = os.path.basename(input_file_path)+'.zst'
-    zst_dir_path = '/tmp/dataset'
-    zst_file_path = f'{zst_dir_path}/{zst_file_name}'
-    if not os.path.exists(zst_dir_path):
-        os.mkdir(zst_dir_path)
-    with open(zst_file_path, 'w') as _:
-        pass
-    try:
-        compress_file_with_zst(input_file_path, zst_file_path)
-
-        upload_file(
-            path_or_fileobj=zst_file_path,
-            path_in_repo=zst_file_name,
-            repo_id=f"{hf_username}/{dataset_name}",
-            repo_type="dataset"
-        )
-    except Exception as e:
-        print('input_file_path: ', input_file_path)
-        print('error ', e)
 
 def get_args():
     parser = argparse.ArgumentParser() 
     parser.add_argument('--start', type=int, required=True)
     parser.add_argument('--end', type=int, required=True)
     parser.add_argument('--target_dir', type=str, required=True)
-    parser.add_argument('--hf_username', type=str, required=True)
-    parser.add_argument('--dataset_name', type=str, required=True)
+    parser.add_argument('--hf_username', type=str, default='')
+    parser.add_argument('--dataset_name', type=str, default='')
+    parser.add_argument('--upload_dir', type=str, default='', help='指定するとHugging Faceではなくこのディレクトリにアップロードする')
+    parser.add_argument('--work_dir', type=str, default='/tmp/dataset', help='圧縮したファイルを一時的に置くディレクトリ')
+    parser.add_argument('--level', type=int, default=3, help='zstdの圧縮レベル')
+    parser.add_argument('--threads', type=int, default=-1, help='圧縮のthread数 (-1ならCPU数)')
+    parser.add_argument('--frame_size', type=int, default=None, help='指定すると約frame_size MBごとのframeに分けたseekableな.zstにする')
+    parser.add_argument('--compress_workers', type=int, default=1)
+    parser.add_argument('--upload_workers', type=int, default=1)
+    parser.add_argument('--batch_files', type=int, default=4, help='1回のcommitでまとめてアップロードするファイル数の上限')
+    parser.add_argument('--queue_size', type=int, default=2, help='圧縮済みでアップロード待ちのファイル数')
+    parser.add_argument('--max_retries', type=int, default=5)
+    parser.add_argument('--manifest', type=str, default='')
     args = parser.parse_args()
+    if not args.upload_dir and not (args.hf_username and args.dataset_name):
+        parser.error('--hf_username and --dataset_name are required unless --upload_dir is given')
     print(args.start)
     print(args.end)
 
@@ -56,11 +124,62 @@ def get_args():
 
 def main():
     args = get_args()
-    for i in range(args.start, args.end):
+    uploader = get_uploader(args)
+    ## ファイルごとの状態 (compressed / uploaded / failed) を記録し、再実行時はuploadedのものを飛ばす
+    manifest = Manifest(args.manifest or os.path.join(args.target_dir, 'upload_manifest.json'))
+    os.makedirs(args.work_dir, exist_ok=True)
+    frame_size = args.frame_size << 20 if args.frame_size else None
+
+    def compress(i):
         file_path = f"{args.target_dir}/{i}.jsonl"
-        upload(file_path, args.hf_username, args.dataset_name)        
-        time.sleep(1)
+        ## --output_format parquetの出力 (row groupごとに圧縮済み) はそのままアップロードする
+        if not os.path.exists(file_path) and os.path.exists(f"{args.target_dir}/{i}.parquet"):
+            file_path = f"{args.target_dir}/{i}.parquet"
+        input_hash = file_fingerprint(file_path)
+        if manifest.is_done(i, 'upload', input_hash):
+            print('skip upload, already uploaded', i)
+            return None
+        if file_path.endswith('.parquet'):
+            manifest.reset(i, 'upload', input=file_path, input_hash=input_hash, status='compressed')
+            return i, file_path
+        zst_file_path = os.path.join(args.work_dir, os.path.basename(file_path) + '.zst')
+        digest = compress_file_with_zst(file_path, zst_file_path, level=args.level,
+                                        threads=args.threads, frame_size=frame_size)
+        verify_zst(zst_file_path, digest)
+        manifest.reset(i, 'upload', input=file_path, input_hash=input_hash, status='compressed')
+        return i, zst_file_path
+
+    def upload_batch(compressed):
+        ## 圧縮が終わって待っているファイルをまとめて1つのcommitでアップロードする
+        todo = [c for c in compressed if c is not None]
+        if todo:
+            files = [(zst_file_path, os.path.basename(zst_file_path)) for _, zst_file_path in todo]
+            try:
+                remotes = retry(lambda: uploader.upload_many(files, commit_message=f'Upload parts {[i for i, _ in todo]}'),
+                                max_retries=args.max_retries, name='upload')
+            except Exception as e:
+                for i, _ in todo:
+                    manifest.update(i, 'upload', status='failed', error=str(e))
+                raise
+            for (i, zst_file_path), remote in zip(todo, remotes):
+                if not zst_file_path.endswith('.parquet'):
+                    os.remove(zst_file_path)
+                manifest.update(i, 'upload', status='uploaded', remote=remote, done=True)
+        return [None if c is None else manifest.get(c[0], 'upload').get('remote') for c in compressed]
+
+    ## part i+1の圧縮とpart iのアップロードを並行に進める
+    stages = [
+        Stage('compress', compress, args.compress_workers),
+        Stage('upload', upload_batch, args.upload_workers, batch_size=args.batch_files),
+    ]
+    results, failures = run_pipeline(range(args.start, args.end), stages, queue_size=args.queue_size)
+    print('done parts', sorted(i for i, _ in results))
+    for i, stage_name, e in failures:
+        print('failed part', i, stage_name, e)
+    ## 失敗したpartがあれば、呼び出し側 (cronやshellのloop) で分かるように0以外で終了する
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()